@@ -0,0 +1,130 @@
+"""
+Solve many crafting problems against one domain in a pool of worker
+processes.
+
+Each problem is a dict like the test cases in autoHTN.py:
+    {'name': ..., 'initial': {'plank': 1}, 'goal': {'cart': 1}, 'time': 175}
+('name' is optional). Every worker declares the domain's operators, methods
+and heuristic once, when it starts, and then plans whole chunks of problems.
+
+    results = solve_batch(data, problems)           # in input order
+    for i, result in iter_batch(data, problems):    # as workers finish
+        ...
+
+Each result is a dict with the problem's 'name', the 'plan' (False if there
+is none), its 'time_cost' and the planner 'runtime' in seconds. With
+bulk=True the domain is declared with autoHTN's bulk methods, so plans may
+contain run-length actions ('op_...', ID, k); see autoHTN.expand_plan.
+With compiled=True the workers import the domain compiled by
+compile_domain instead of building it from the JSON, and with
+subplans=True each worker reuses the have_enough subplans and failures it
+has already found (autoHTN.add_subplan_cache, opt-in). time_bound=True adds autoHTN's time
+bound to the checks.
+"""
+
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import autoHTN
+import compile_domain
+import pyhop
+
+ID = 'agent'
+
+def declare_domain(data, ID=ID, max_depth=1000, bulk=False, compiled=False, subplans=False, time_bound=False):
+    """
+    Declare data's operators, methods and checks in this process's pyhop.
+    With compiled=True the operators and methods come from compile_domain's
+    cached module. With subplans=True have_enough subplans are remembered
+    (autoHTN.add_subplan_cache) for every later problem in the process.
+    With time_bound=True branches that can't finish in the Time left are
+    pruned (autoHTN.add_time_bound).
+    """
+    # Forked workers inherit the checks the parent declared
+    pyhop.clear_checks()
+    if compiled:
+        compile_domain.declare_domain(data, bulk)
+    else:
+        autoHTN.declare_operators(data)
+        autoHTN.declare_methods(data, bulk)
+    autoHTN.add_heuristic(data, ID, max_depth)
+    if time_bound:
+        autoHTN.add_time_bound(data, ID)
+    if subplans:
+        autoHTN.add_subplan_cache(data, ID)
+
+def solve_problem(data, problem, ID=ID, **options):
+    """
+    Plan one problem with the domain already declared in this process.
+    options are passed on to pyhop.pyhop (engine, trail, ...).
+    """
+    problem_data = autoHTN.set_problem(data, problem.get('initial', {}), problem['goal'], problem['time'])
+    state = autoHTN.set_up_state(problem_data, ID)
+    goals = autoHTN.set_up_goals(problem_data, ID)
+
+    t0 = time.perf_counter()
+    plan = pyhop.pyhop(state, goals, **options)
+    runtime = time.perf_counter() - t0
+
+    return {
+        'name': problem.get('name'),
+        'plan': plan,
+        'time_cost': autoHTN.plan_time(data, plan) if plan is not False else None,
+        'runtime': runtime,
+    }
+
+# The domain each worker process declared in _init_worker
+_worker_data = None
+
+def _init_worker(data, max_depth, bulk, compiled, subplans, time_bound):
+    global _worker_data
+    _worker_data = data
+    declare_domain(data, ID, max_depth, bulk, compiled, subplans, time_bound)
+
+def _solve_chunk(start, problems, options):
+    return start, [solve_problem(_worker_data, problem, ID, **options) for problem in problems]
+
+def iter_batch(data, problems, processes=None, chunksize=1, max_depth=1000, bulk=False, compiled=False, subplans=False, time_bound=False, **options):
+    """
+    Plan problems in a pool of processes worker processes (one per core by
+    default), chunksize problems per job. Yields (index, result) pairs as the
+    jobs finish, so the order is not the input order.
+    """
+    problems = list(problems)
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(data, max_depth, bulk, compiled, subplans, time_bound)) as pool:
+        jobs = [pool.submit(_solve_chunk, start, problems[start:start + chunksize], options)
+                for start in range(0, len(problems), chunksize)]
+        for job in as_completed(jobs):
+            start, results = job.result()
+            for offset, result in enumerate(results):
+                yield start + offset, result
+
+def solve_batch(data, problems, processes=None, chunksize=1, max_depth=1000, bulk=False, compiled=False, subplans=False, time_bound=False, **options):
+    """Like iter_batch, but wait for every problem and return the results in input order."""
+    problems = list(problems)
+    results = [None] * len(problems)
+    for i, result in iter_batch(data, problems, processes, chunksize, max_depth, bulk, compiled, subplans, time_bound, **options):
+        results[i] = result
+    return results
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 3:
+        print('usage: python batch.py crafting.json problems.json [processes]')
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        data = json.load(f)
+    with open(sys.argv[2]) as f:
+        problems = json.load(f)
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    # Compile once here so the workers only have to import the module
+    compile_domain.load_domain(data)
+    for i, result in iter_batch(data, problems, processes, compiled=True, engine='iterative'):
+        name = result['name'] or 'problem {}'.format(i)
+        if result['plan'] is False:
+            print('{}: no plan ({:.4f}s)'.format(name, result['runtime']))
+        else:
+            print('{}: {} steps, time cost {} ({:.4f}s)'.format(
+                name, len(result['plan']), result['time_cost'], result['runtime']))
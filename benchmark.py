@@ -0,0 +1,263 @@
+"""
+Planner benchmarks on crafting.json.
+
+Runs the test cases from autoHTN.TEST_CASES plus goal-scaling sweeps
+(rail from 10 to 1000, cart from 1 to 20, with time limits that grow with
+the goal) and records, for each run:
+
+- wall_time    best planner time over --repeat runs, in seconds
+- nodes        search nodes expanded
+- backtracks   nodes whose alternatives all failed
+- max_depth    deepest search node
+- peak_memory  peak bytes allocated while planning (from a separate
+               tracemalloc run, so it doesn't slow down wall_time)
+- plan_length  number of actions in the plan (None if there is no plan)
+- time_cost    in-game Time the plan uses
+
+    python benchmark.py --out results.json
+    python benchmark.py --baseline results.json
+
+The new results are compared with a stored run, by default
+benchmark_baseline.json (made with --quick on the default settings; pass
+--baseline '' to skip it), and the script exits with status 1 if any
+metric got worse by more than its threshold in THRESHOLDS. Runs missing
+from the baseline, like the sweeps, aren't compared. --time-bound adds autoHTN's time bound to the
+checks, and --check-time-bound first makes sure it doesn't change any plan
+or make autoHTN.optimize miss a cheaper one (see check_time_bound and
+check_optimize).
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import autoHTN
+import compile_domain
+import pyhop
+
+ID = 'agent'
+
+RAIL_SWEEP = [10, 20, 50, 100, 200, 500, 1000]
+CART_SWEEP = [1, 2, 5, 10, 20]
+
+# (name, initial, goal, time) runs where an inadmissible time bound once
+# changed the plan or made the search take minutes
+TIME_BOUND_CASES = [
+    ('ingot-2', {}, {'ingot': 2}, 70),
+    ('ingot-3', {'plank': 2, 'iron_pickaxe': 1}, {'ingot': 3}, 47),
+]
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# Allowed relative increase of each metric over the baseline
+THRESHOLDS = {
+    'wall_time': 0.25,
+    'peak_memory': 0.20,
+    'nodes': 0.0,
+    'backtracks': 0.0,
+    'plan_length': 0.0,
+}
+# wall_time differences below this many seconds are treated as noise
+MIN_WALL_TIME = 0.001
+
+def benchmark_cases(quick=False):
+    """The (name, initial, goal, time) runs of the suite."""
+    cases = [(case['name'].split('.')[0], case['initial'], case['goal'], case['time'])
+             for case in autoHTN.TEST_CASES]
+    if quick:
+        return cases
+    cases += [('rail-{}'.format(n), {}, {'rail': n}, 120 + 5 * n) for n in RAIL_SWEEP]
+    cases += [('cart-{}'.format(n), {}, {'cart': n}, 60 + 60 * n) for n in CART_SWEEP]
+    return cases
+
+def declare_checks(data, time_bound=False, max_depth=10**9):
+    """Replace the checks with autoHTN's heuristic and, with time_bound, its time bound."""
+    # The sweeps make plans thousands of steps long
+    pyhop.clear_checks()
+    autoHTN.add_heuristic(data, ID, max_depth)
+    if time_bound:
+        autoHTN.add_time_bound(data, ID)
+
+def check_time_bound(data, cases=None):
+    """
+    Plan cases (the test cases and TIME_BOUND_CASES by default) with and
+    without autoHTN's time bound and return the names of those whose plans
+    differ. The bound never overestimates the Time a node needs, so it
+    should only prune branches that fail anyway: the same plan comes first,
+    after no more nodes. The search with the bound is stopped once it has
+    expanded more nodes than the one without, and then counts as differing.
+    The checks are left declared without the bound.
+    """
+    if cases is None:
+        cases = benchmark_cases(quick=True) + TIME_BOUND_CASES
+    changed = []
+    for name, initial, goal, max_time in cases:
+        problem = autoHTN.set_problem(data, initial, goal, max_time)
+        plans = []
+        budget = None
+        for time_bound in (False, True):
+            declare_checks(data, time_bound)
+            stats = pyhop.SearchStats()
+            stop = None if budget is None else (lambda: stats.nodes > budget)
+            plans.append(next(pyhop.search(autoHTN.set_up_state(problem, ID), autoHTN.set_up_goals(problem, ID),
+                                           [], 0, stats=stats, stop=stop), False))
+            budget = stats.nodes
+        if plans[0] != plans[1]:
+            changed.append(name)
+    declare_checks(data)
+    return changed
+
+def check_optimize(data, cases=None):
+    """
+    Run autoHTN.optimize on cases (TIME_BOUND_CASES by default) and return
+    the names of those it calls optimal although branch and bound on the
+    Time used so far alone finds a cheaper plan. Only an overestimating time
+    bound can make optimize prune the cheapest plan.
+    """
+    if cases is None:
+        cases = TIME_BOUND_CASES
+    declare_checks(data)
+    wrong = []
+    for name, initial, goal, max_time in cases:
+        problem = autoHTN.set_problem(data, initial, goal, max_time)
+        result = autoHTN.optimize(problem, ID)
+        best = None
+        for plan, cost in pyhop.branch_and_bound(autoHTN.set_up_state(problem, ID), autoHTN.set_up_goals(problem, ID),
+                                                 lambda plan: autoHTN.plan_time(problem, plan),
+                                                 lambda state, tasks, plan: max_time - state.time[ID],
+                                                 nogoods=pyhop.NogoodTable()):
+            best = cost
+        if result['optimal'] and best is not None and best < result['time_cost']:
+            wrong.append(name)
+    return wrong
+
+def run_case(data, initial, goal, max_time, repeat=3, **options):
+    """Plan one case repeat times and return its metrics."""
+    problem = autoHTN.set_problem(data, initial, goal, max_time)
+    goals = autoHTN.set_up_goals(problem, ID)
+
+    wall_time = None
+    for _ in range(repeat):
+        state = autoHTN.set_up_state(problem, ID)
+        stats = pyhop.SearchStats()
+        t0 = time.perf_counter()
+        plan = pyhop.pyhop(state, goals, stats=stats, **options)
+        elapsed = time.perf_counter() - t0
+        if wall_time is None or elapsed < wall_time:
+            wall_time = elapsed
+
+    state = autoHTN.set_up_state(problem, ID)
+    tracemalloc.start()
+    pyhop.pyhop(state, goals, **options)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'wall_time': wall_time,
+        'nodes': stats.nodes,
+        'backtracks': stats.backtracks,
+        'max_depth': stats.max_depth,
+        'peak_memory': peak_memory,
+        'plan_length': len(plan) if plan is not False else None,
+        'time_cost': autoHTN.plan_time(data, plan) if plan is not False else None,
+    }
+
+def run_suite(data, quick=False, repeat=3, verbose=True, **options):
+    runs = {}
+    for name, initial, goal, max_time in benchmark_cases(quick):
+        runs[name] = run_case(data, initial, goal, max_time, repeat, **options)
+        if verbose:
+            m = runs[name]
+            print('{:<10} {:>9.4f}s {:>8} nodes {:>7} backtracks {:>10} bytes  plan {}'.format(
+                name, m['wall_time'], m['nodes'], m['backtracks'], m['peak_memory'], m['plan_length']))
+    return runs
+
+def compare(runs, baseline, thresholds=THRESHOLDS):
+    """Return a list of messages, one per metric that regressed against baseline."""
+    regressions = []
+    for name, base in sorted(baseline.items()):
+        if name not in runs:
+            continue
+        new = runs[name]
+        for metric, threshold in thresholds.items():
+            old_value, new_value = base.get(metric), new.get(metric)
+            if old_value is None or new_value is None:
+                if old_value != new_value:
+                    regressions.append('{} {}: {} -> {}'.format(name, metric, old_value, new_value))
+                continue
+            if metric == 'wall_time' and new_value - old_value < MIN_WALL_TIME:
+                continue
+            if new_value > old_value * (1 + threshold):
+                regressions.append('{} {}: {} -> {} (+{:.1%}, allowed {:.0%})'.format(
+                    name, metric, old_value, new_value,
+                    (new_value - old_value) / old_value if old_value else float('inf'), threshold))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--domain', default='crafting.json')
+    parser.add_argument('--engine', default='iterative')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--bulk', action='store_true', help="use autoHTN's bulk production methods")
+    parser.add_argument('--compiled', action='store_true', help='use the domain compiled by compile_domain')
+    parser.add_argument('--quick', action='store_true', help='only run the test cases, not the sweeps')
+    parser.add_argument('--time-bound', action='store_true', help="add autoHTN's time bound to the checks")
+    parser.add_argument('--check-time-bound', action='store_true',
+                        help='first check that the time bound changes no plan or optimal cost, and exit with status 1 if it does')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=BASELINE, help='compare against the results in this JSON file')
+    args = parser.parse_args()
+
+    with open(args.domain) as f:
+        data = json.load(f)
+
+    if args.compiled:
+        compile_domain.declare_domain(data, args.bulk)
+    else:
+        autoHTN.declare_operators(data)
+        autoHTN.declare_methods(data, args.bulk)
+
+    if args.check_time_bound:
+        changed = check_time_bound(data)
+        if changed:
+            print('The time bound changes the plans of', ', '.join(changed))
+            sys.exit(1)
+        print('The time bound changes no plan')
+        wrong = check_optimize(data)
+        if wrong:
+            print('optimize misses a cheaper plan for', ', '.join(wrong))
+            sys.exit(1)
+        print('optimize finds the cheapest plans')
+    declare_checks(data, args.time_bound)
+
+    runs = run_suite(data, args.quick, args.repeat, engine=args.engine)
+    results = {
+        'meta': {
+            'domain': args.domain,
+            'engine': args.engine,
+            'bulk': args.bulk,
+            'compiled': args.compiled,
+            'time_bound': args.time_bound,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+        },
+        'runs': runs,
+    }
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['runs']
+        regressions = compare(runs, baseline)
+        for message in regressions:
+            print('REGRESSION', message)
+        if regressions:
+            sys.exit(1)
+        print('No regressions against', args.baseline)
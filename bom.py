@@ -0,0 +1,207 @@
+"""
+Plan crafting problems by arithmetic where the recipes leave no choice,
+and by search only where they do.
+
+Products made by a single recipe form a DAG: a product depends on the items
+its recipe consumes and the tools it requires. Walking that DAG from the
+goal down (in the order autoHTN.set_order gives, dependents first) adds up
+exactly how many times each recipe has to run and how much of each other
+item it takes, the bill of materials. Running the recipes in the opposite
+order, each one all its times in one batch, makes the goal: every batch
+finds its inputs and tools already made.
+
+The items at the bottom of the bill are the ones with several recipes
+(wood by punching or with an axe, cobble with one of three pickaxes, ...)
+or none. pyhop plans only those, as one have_enough task per item for the
+whole amount, after the tools the batches need (which gathering usually
+needs too), with the Time the batches leave over. The bill is then worked
+out again from the state that plan reaches, since it may have made some
+tools or intermediate items on the way, and its batches finish the plan.
+If any of that fails, pyhop plans the whole problem instead.
+
+    result = solve(data)      # data's operators and methods already declared
+    result['plan'], result['time_cost'], result['solver']   # 'bom' or 'pyhop'
+"""
+
+import json
+import sys
+
+import autoHTN
+import pyhop
+import validate
+
+ID = 'agent'
+
+def single_recipes(data):
+    """{product: its recipe name} for the products that only one recipe makes."""
+    recipes = {}
+    for name, rule in data['Recipes'].items():
+        for product in rule['Produces']:
+            recipes.setdefault(product, []).append(name)
+    return {product: names[0] for product, names in recipes.items() if len(names) == 1}
+
+def bill_of_materials(data, goal, have, single=None):
+    """
+    ({recipe name: runs}, recipe names in the order to run them, {item: amount
+    needed}) that make goal from the counts in have, with only the products
+    in single (single_recipes(data) by default) made by recipes. The last
+    dict holds every other item the bill needs, including what have already
+    has. None if the single recipes depend on each other in a cycle.
+    """
+    recipes = data['Recipes']
+    if single is None:
+        single = single_recipes(data)
+
+    # The products goal needs, and what each of them depends on
+    dep_map = {}
+    pending = list(goal)
+    while pending:
+        item = pending.pop()
+        if item in dep_map:
+            continue
+        deps = set()
+        if item in single:
+            rule = recipes[single[item]]
+            deps.update(rule.get('Consumes', {}))
+            deps.update(tool for tool in rule.get('Requires', {}) if have.get(tool, 0) < 1)
+        dep_map[item] = deps
+        pending.extend(deps)
+
+    order = autoHTN.set_order(dep_map, dep_map)
+    position = {item: i for i, item in enumerate(order)}
+    for item, deps in dep_map.items():
+        for dep in deps:
+            if position[dep] <= position[item]:
+                return None
+
+    need = dict(goal)
+    runs = {}
+    leaves = {}
+    for item in order:
+        if item not in single:
+            if need.get(item, 0) > 0:
+                leaves[item] = need[item]
+            continue
+        missing = need.get(item, 0) - have.get(item, 0)
+        if missing <= 0:
+            continue
+        name = single[item]
+        rule = recipes[name]
+        k = -(-missing // rule['Produces'][item])
+        runs[name] = k
+        for input_item, amt in rule.get('Consumes', {}).items():
+            need[input_item] = need.get(input_item, 0) + amt * k
+        for tool, amt in rule.get('Requires', {}).items():
+            need[tool] = max(need.get(tool, 0), amt)
+    return runs, [single[item] for item in reversed(order) if single.get(item) in runs], leaves
+
+def batch_time(data, runs):
+    """Time the batches of runs take."""
+    return sum(data['Recipes'][name].get('Time', 0) * k for name, k in runs.items())
+
+def batches(runs, order, ID=ID, bulk=False):
+    """The actions of the batches: ('op_...', ID, k) with bulk, else k single actions each."""
+    plan = []
+    for name in order:
+        op_name = 'op_' + name.replace(' ', '_')
+        if bulk:
+            plan.append((op_name, ID, runs[name]))
+        else:
+            plan.extend([(op_name, ID)] * runs[name])
+    return plan
+
+def bom_plan(data, ID=ID, bulk=False, max_nodes=2000):
+    """
+    A plan for data['Problem'] made of a pyhop plan for the tools and the
+    items at the bottom of the bill of materials, followed by the bill's
+    batches, or False if that doesn't work out. The pyhop search gives up
+    after max_nodes nodes.
+    """
+    problem = data['Problem']
+    initial, goal, max_time = problem['Initial'], problem['Goal'], problem['Time']
+    single = single_recipes(data)
+    bom = bill_of_materials(data, goal, initial, single)
+    if bom is None:
+        return False
+
+    # Gathering the leaves usually needs the same tools as the batches
+    # (a bench for the pickaxes), so pyhop makes the bill's tools first
+    made = {product for name in bom[0] for product in data['Recipes'][name]['Produces']}
+    tools = [tool for tool in data['Tools'] if tool in made]
+    if tools:
+        bom = bill_of_materials(data, goal, dict(initial, **{tool: 1 for tool in tools}), single)
+        if bom is None:
+            return False
+    runs, order, leaves = bom
+
+    missing = [(item, num) for item, num in leaves.items() if num > initial.get(item, 0)]
+    subplan = []
+    have = initial
+    if tools or missing:
+        # Gathering one item may use up another (wood for a pickaxe), so a
+        # second round tops them up
+        tasks = [('have_enough', ID, tool, 1) for tool in tools] + \
+                [('have_enough', ID, item, num) for item, num in missing] * 2
+        leaf_problem = autoHTN.set_problem(data, initial, goal, max_time - batch_time(data, runs))
+        nodes = [0]
+
+        def stop():
+            nodes[0] += 1
+            return nodes[0] > max_nodes
+
+        subplan = next(pyhop.search(autoHTN.set_up_state(leaf_problem, ID), tasks, [], 0, stop=stop), False)
+        if subplan is False:
+            return False
+        have = validate.PlanValidator(data, ID).validate(subplan, initial, {}, max_time)['inventory']
+        bom = bill_of_materials(data, goal, have, single)
+        if bom is None:
+            return False
+        runs, order, leaves = bom
+        if any(num > have.get(item, 0) for item, num in leaves.items()):
+            return False
+
+    plan = subplan + batches(runs, order, ID, bulk)
+    if autoHTN.plan_time(data, plan) > max_time:
+        return False
+    return plan
+
+def solve(data, ID=ID, bulk=False, max_nodes=2000, **options):
+    """
+    Plan data['Problem'] with bom_plan, or with pyhop if that finds nothing.
+    Returns a dict with the 'plan' (False if neither finds one), its
+    'time_cost' and the 'solver' that found it. options are passed on to
+    pyhop, which uses whatever operators, methods and checks are declared.
+    """
+    plan = bom_plan(data, ID, bulk, max_nodes)
+    solver = 'bom'
+    if plan is False:
+        solver = 'pyhop'
+        plan = pyhop.pyhop(autoHTN.set_up_state(data, ID), autoHTN.set_up_goals(data, ID), **options)
+    return {
+        'plan': plan,
+        'time_cost': autoHTN.plan_time(data, plan) if plan is not False else None,
+        'solver': solver,
+    }
+
+if __name__ == '__main__':
+    import time
+
+    rules_filename = 'crafting.json'
+    if len(sys.argv) > 1:
+        rules_filename = sys.argv[1]
+    with open(rules_filename) as f:
+        data = json.load(f)
+
+    autoHTN.declare_operators(data)
+    autoHTN.declare_methods(data)
+    autoHTN.add_heuristic(data, ID)
+
+    for case in autoHTN.TEST_CASES:
+        problem = autoHTN.set_problem(data, case['initial'], case['goal'], case['time'])
+        t0 = time.perf_counter()
+        result = solve(problem, engine='iterative')
+        t1 = time.perf_counter()
+        plan = result['plan']
+        print('{:<60} {:<6} {:>9.4f}s  {}'.format(
+            case['name'], result['solver'], t1 - t0,
+            'no plan' if plan is False else '{} steps, time {}'.format(len(plan), result['time_cost'])))
@@ -0,0 +1,222 @@
+"""
+Compile a crafting domain (crafting.json) into a Python module.
+
+autoHTN.make_operator and make_method build generic closures that loop
+over each recipe's Requires/Consumes/Produces dicts on every call. The
+compiled module has one straight-line function per recipe instead, with
+the slot offsets and amounts written into the code:
+
+    def op_craft_plank(state, ID, k=1, trail=None):
+        if type(state) is CompactState and state.index is INDEX:
+            values = state.values
+            if values[0] < k or values[2] < k:
+                return False
+            ...
+
+The generated operators and methods behave exactly like autoHTN's (the
+same k, trail, slot_effects and plain State support), so plans don't
+change. Each module is written to cache_dir under a hash of the domain
+(Items, Tools and Recipes, not Problem) and of the source of autoHTN and
+this compiler, so it is generated once and later processes import it from
+its cached bytecode.
+
+    compile_domain.declare_domain(data, bulk=False)   # instead of
+    autoHTN.declare_operators(data)                   # these two
+    autoHTN.declare_methods(data, bulk)
+"""
+
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import sys
+
+import autoHTN
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__domaincache__')
+
+def _source_hash(*modules):
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+# The generated code also follows autoHTN's method ordering and this file's
+# templates, so editing either must not reuse an old module
+COMPILER_VERSION = _source_hash(autoHTN, sys.modules[__name__])
+
+def domain_key(data):
+    """Hash of the parts of data and of the compiler that the compiled module depends on."""
+    domain = {name: data[name] for name in ('Items', 'Tools', 'Recipes')}
+    text = COMPILER_VERSION + json.dumps(domain, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+def _identifier(name, used):
+    """
+    A Python identifier for name that isn't in used yet, and add it to used.
+    Names that only differ in characters an identifier can't hold (iron
+    pickaxe, iron_pickaxe) get a numbered suffix instead of one silently
+    replacing the other in the module.
+    """
+    base = re.sub(r'\W', '_', name)
+    identifier, n = base, 1
+    while identifier in used or '_' + identifier in used:
+        n += 1
+        identifier = '{}_{}'.format(base, n)
+    used.update((identifier, '_' + identifier))
+    return identifier
+
+def _times_k(amt):
+    return 'k' if amt == 1 else '{} * k'.format(amt)
+
+def _compile_operator(op_name, rule, index, used):
+    req = rule.get('Requires', {})
+    cons = rule.get('Consumes', {})
+    prod = rule.get('Produces', {})
+    t_c = rule.get('Time', 0)
+    t_slot = index['time']
+    func = _identifier(op_name, used)
+
+    tests = ['values[{}] < {}'.format(t_slot, _times_k(t_c))]
+    tests += ['values[{}] < {}'.format(index[item], amt) for item, amt in req.items()]
+    tests += ['values[{}] < {}'.format(index[item], _times_k(amt)) for item, amt in cons.items()]
+    changed = [t_slot] + [index[item] for item in cons] + [index[item] for item in prod]
+
+    lines = ['def {}(state, ID, k=1, trail=None):'.format(func),
+             '    if type(state) is CompactState and state.index is INDEX:',
+             '        values = state.values',
+             '        if {}:'.format(' or '.join(tests)),
+             '            return False',
+             '        if trail is not None:']
+    lines += ['            trail.append((values, {0}, values[{0}]))'.format(slot) for slot in changed]
+    lines.append('        values[{}] -= {}'.format(t_slot, _times_k(t_c)))
+    lines += ['        values[{}] -= {}'.format(index[item], _times_k(amt)) for item, amt in cons.items()]
+    lines += ['        values[{}] += {}'.format(index[item], _times_k(amt)) for item, amt in prod.items()]
+    lines += ['        return state',
+              '    return _{}(state, ID, k, trail)'.format(func),
+              '',
+              '_{} = autoHTN.make_operator({!r})'.format(func, rule),
+              '{}.__name__ = {!r}'.format(func, op_name),
+              '{}.trail_aware = True'.format(func),
+              '{}.slot_effects = (INDEX, {}, {}, {!r}, {!r}, {!r})'.format(
+                  func, t_slot, t_c,
+                  [(index[item], amt) for item, amt in req.items()],
+                  [(index[item], amt) for item, amt in cons.items()],
+                  [(index[item], amt) for item, amt in prod.items()]),
+              '']
+    return func, lines
+
+def _compile_method(method, rule, product, index, used):
+    recipe = method._meta['recipe']
+    req = rule.get('Requires', {})
+    cons = rule.get('Consumes', {})
+    order = method._meta['consumes_order']
+    op_name = 'op_{}'.format(recipe.replace(' ', '_'))
+    # A recipe with several products gets one method per product
+    func = _identifier('{}_{}'.format(method.__name__, product), used)
+    bulk = _identifier('bulk_{}_{}'.format(recipe.replace(' ', '_'), product), used)
+
+    subtasks = ["('have_enough', ID, {!r}, {!r})".format(item, amt) for item, amt in req.items()]
+    subtasks += ["('have_enough', ID, {!r}, {!r})".format(item, cons[item]) for item in order]
+    subtasks.append('({!r}, ID)'.format(op_name))
+
+    bulk_subtasks = ["('have_enough', ID, {!r}, {!r})".format(item, amt) for item, amt in req.items()]
+    bulk_subtasks += ["('have_enough', ID, {!r}, {})".format(item, _times_k(cons[item])) for item in order]
+    bulk_subtasks += ['({!r}, ID, k)'.format(op_name), "('have_enough', ID, {!r}, num)".format(product)]
+
+    lines = ['def {}(state, ID):'.format(func),
+             '    return [{}]'.format(', '.join(subtasks)),
+             '',
+             'def {}(state, ID, num):'.format(bulk),
+             '    if type(state) is CompactState and state.index is INDEX:',
+             '        have = state.values[{}]'.format(index[product]),
+             '    else:',
+             '        have = getattr(state, {!r})[ID]'.format(product),
+             '    k = -(-(num - have) // {})'.format(rule['Produces'][product]),
+             '    if k <= 0:',
+             '        return []',
+             '    return [{}]'.format(', '.join(bulk_subtasks)),
+             '',
+             '{}.__name__ = {!r}'.format(func, method.__name__),
+             '{}.__name__ = {!r}'.format(bulk, 'bulk_{}'.format(recipe.replace(' ', '_'))),
+             '{}._meta = {!r}'.format(func, method._meta),
+             '{}._bulk = {}'.format(func, bulk),
+             '']
+    return func, lines
+
+def compile_domain(data):
+    """The source of the compiled module for data's domain."""
+    index = autoHTN.make_index(data)
+    lines = ['# Generated by compile_domain.py for domain {}. Do not edit.'.format(domain_key(data)),
+             '',
+             'import autoHTN',
+             'import pyhop',
+             'from pyhop import CompactState',
+             '',
+             'INDEX = autoHTN.make_index({!r})'.format({'Items': data['Items'], 'Tools': data['Tools']}),
+             '']
+
+    used = {'autoHTN', 'pyhop', 'CompactState', 'INDEX', 'OPERATORS', 'PRODUCT_METHODS', 'declare'}
+    operators = []
+    for recipe_name, rule in data['Recipes'].items():
+        func, op_lines = _compile_operator('op_' + recipe_name.replace(' ', '_'), rule, index, used)
+        operators.append(func)
+        lines += op_lines
+
+    products = []
+    for product, method_list in autoHTN.product_methods(data).items():
+        funcs = []
+        for method in method_list:
+            func, method_lines = _compile_method(method, data['Recipes'][method._meta['recipe']], product, index, used)
+            funcs.append(func)
+            lines += method_lines
+        products.append('    {!r}: [{}],'.format(product, ', '.join(funcs)))
+
+    lines += ['OPERATORS = [{}]'.format(', '.join(operators)),
+              '',
+              'PRODUCT_METHODS = {'] + products + ['}',
+              '',
+              'def declare(bulk=False):',
+              '    pyhop.declare_operators(*OPERATORS)',
+              '    autoHTN.declare_product_methods(PRODUCT_METHODS, bulk)',
+              '']
+    return '\n'.join(lines)
+
+def load_domain(data, cache_dir=CACHE_DIR):
+    """
+    The compiled module for data's domain. It is compiled and written to
+    cache_dir the first time, and imported from there afterwards.
+    """
+    name = 'domain_{}'.format(domain_key(data))
+    if name in sys.modules:
+        return sys.modules[name]
+
+    path = os.path.join(cache_dir, name + '.py')
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write under a temporary name so other processes never import half a file
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(compile_domain(data))
+        os.replace(tmp_path, path)
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def declare_domain(data, bulk=False, cache_dir=CACHE_DIR):
+    """Declare data's compiled operators and methods in pyhop."""
+    load_domain(data, cache_dir).declare(bulk)
+
+if __name__ == '__main__':
+    rules_filename = 'crafting.json'
+    if len(sys.argv) > 1:
+        rules_filename = sys.argv[1]
+    with open(rules_filename) as f:
+        data = json.load(f)
+    module = load_domain(data)
+    print('compiled {} recipes into {}'.format(len(data['Recipes']), module.__file__))
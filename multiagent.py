@@ -0,0 +1,292 @@
+"""
+Plan for many agents that share one domain but have different inventories
+and time budgets.
+
+Every agent's state is one row of a single agents-by-slots matrix (a flat
+array of ints laid out like CompactState.values). The search is pyhop's
+depth-first search, run once for a whole group of agents: agents that have
+made the same choices so far share a search node. An operator is checked and
+applied to every row of the group in one pass. Methods and checks are
+evaluated once for each distinct combination of the slots they read. The
+group only splits where the agents' choices differ, so every agent gets
+exactly the plan that pyhop would find for it alone.
+
+    index, rows, tasks = set_up_agents(data, problems)
+    plans = plan_agents(index, rows, tasks)
+
+plan_agents returns one plan (or False) per agent, in row order.
+"""
+
+from array import array
+
+import autoHTN
+import pyhop
+
+ID = 'agent'
+
+def set_up_agents(data, problems, ID=ID):
+    """
+    The slot index, state matrix and per-agent goal tasks for problems, a
+    list of dicts like autoHTN.TEST_CASES ({'initial', 'goal', 'time'}).
+    """
+    index = autoHTN.make_index(data)
+    rows = array('i')
+    tasks = []
+    for problem in problems:
+        problem_data = autoHTN.set_problem(data, problem.get('initial', {}), problem['goal'], problem['time'])
+        rows.extend(autoHTN.set_up_state(problem_data, ID).values)
+        tasks.append(autoHTN.set_up_goals(problem_data, ID))
+    return index, rows, tasks
+
+def plan_agents(index, rows, tasks, ID=ID, stats=None):
+    """
+    Find a plan for every agent. rows holds one row of len(index) ints per
+    agent; tasks is either one task list for all agents or a list with one
+    task list per agent. stats, a pyhop.SearchStats, counts group nodes.
+    """
+    width = len(index)
+    n = len(rows) // width
+    if tasks and isinstance(tasks[0], tuple):
+        tasks = [tasks] * n
+    plans = [False] * n
+
+    # Agents with the same goal start in the same group
+    groups = {}
+    for agent in range(n):
+        groups.setdefault(tuple(tasks[agent]), []).append(agent)
+
+    for agenda, agents in groups.items():
+        root = (agents, _take(rows, agents, width), list(agenda), [], 0, [])
+        stack = []
+        node, failed = root, None
+        while True:
+            if node is not None:
+                agents, group_rows, agenda, plan, depth, calling_stack = node
+                if agenda == []:
+                    for agent in agents:
+                        plans[agent] = plan
+                    failed = []
+                elif len(agents) == 1:
+                    # A lone agent has nothing to share, so it gets pyhop's own search
+                    state = _row_state(group_rows, 0, index, ID)
+                    found = next(pyhop.search(state, agenda, plan, depth, calling_stack=calling_stack, stats=stats), False)
+                    if found is False:
+                        failed = agents
+                    else:
+                        plans[agents[0]] = found
+                        failed = []
+                else:
+                    if stats is not None:
+                        stats.nodes += 1
+                        if depth > stats.max_depth: stats.max_depth = depth
+                    stack.append(_expand(node, index, ID))
+                    failed = None
+            if not stack:
+                break
+            try:
+                node = stack[-1].send(failed)
+            except StopIteration as done:
+                # done.value lists the agents for which this node failed
+                stack.pop()
+                if stats is not None and done.value: stats.backtracks += 1
+                node, failed = None, done.value
+    return plans
+
+def _take(rows, positions, width):
+    """The rows at positions, as a new matrix."""
+    taken = array('i')
+    for i in positions:
+        taken.extend(rows[i * width:(i + 1) * width])
+    return taken
+
+def _row_state(rows, i, index, ID):
+    width = len(index)
+    return pyhop.CompactState('state', index, ID, rows[i * width:(i + 1) * width])
+
+def _apply_operator(operator, args, rows, count, index, ID):
+    """
+    Apply operator to every row. Return (positions it applied to, their new
+    rows, positions it failed for).
+    """
+    width = len(index)
+    done, new_rows, failed = [], array('i'), []
+    effects = getattr(operator, 'slot_effects', None)
+    if effects is not None and effects[0] is index:
+        _, t_slot, t_c, req_slots, cons_slots, prod_slots = effects
+        k = args[1] if len(args) > 1 else 1
+        for i in range(count):
+            base = i * width
+            if (rows[base + t_slot] < t_c * k
+                    or any(rows[base + slot] < amt for slot, amt in req_slots)
+                    or any(rows[base + slot] < amt * k for slot, amt in cons_slots)):
+                failed.append(i)
+                continue
+            row = rows[base:base + width]
+            row[t_slot] -= t_c * k
+            for slot, amt in cons_slots:
+                row[slot] -= amt * k
+            for slot, amt in prod_slots:
+                row[slot] += amt * k
+            done.append(i)
+            new_rows.extend(row)
+        return done, new_rows, failed
+
+    # Operators that don't describe their effects run row by row
+    for i in range(count):
+        newstate = operator(_row_state(rows, i, index, ID), *args)
+        if newstate:
+            done.append(i)
+            new_rows.extend(newstate.values)
+        else:
+            failed.append(i)
+    return done, new_rows, failed
+
+class _Reads(object):
+    """A row that remembers which slots were read from it, slices included, and their values."""
+    __slots__ = ('row', 'read')
+
+    def __init__(self, row):
+        self.row = row
+        self.read = {}
+
+    def __getitem__(self, slot):
+        value = self.row[slot]
+        if type(slot) is slice:
+            for i in range(*slot.indices(len(self.row))):
+                self.read[i] = self.row[i]
+        else:
+            self.read[slot % len(self.row)] = value
+        return value
+
+    def __len__(self):
+        return len(self.row)
+
+def _per_row(func, rows, positions, index, ID):
+    """
+    func(state) for each position. func sees the row through _Reads, and its
+    result is reused for every later row that has the same values in the
+    slots it read, since func would take the same path for that row.
+    """
+    width = len(index)
+    # the slots read by some call -> {their values: result}
+    seen = {}
+    results = []
+    trace = True
+    every_slot = tuple(range(width))
+    for i in positions:
+        row = rows[i * width:(i + 1) * width]
+        for slots, table in seen.items():
+            key = tuple([row[slot] for slot in slots])
+            if key in table:
+                results.append(table[key])
+                break
+        else:
+            if trace:
+                values = _Reads(row)
+                result = func(pyhop.CompactState('state', index, ID, values))
+                slots = tuple(sorted(values.read))
+                # A func that reads most of the row is cheaper to key on all of it
+                if 2 * len(slots) > width:
+                    trace = False
+            else:
+                result = func(pyhop.CompactState('state', index, ID, row))
+                slots = every_slot
+            seen.setdefault(slots, {})[tuple([row[slot] for slot in slots])] = result
+            results.append(result)
+    return results
+
+def _expand(node, index, ID):
+    """
+    Generator for one group node, following pyhop.expand. It yields child
+    nodes and is sent back the agents that failed in each child. It returns
+    the agents for which every alternative failed.
+    """
+    agents, rows, tasks, plan, depth, calling_stack = node
+    width = len(index)
+    task1 = tasks[0]
+    # positions (into agents and rows) still looking for an alternative
+    open_ = list(range(len(agents)))
+    # positions that some child found a plan for
+    solved = set()
+    position = {agent: i for i, agent in enumerate(agents)}
+
+    if task1[0] in pyhop.operators:
+        done, new_rows, failed = _apply_operator(pyhop.operators[task1[0]], task1[1:], rows, len(agents), index, ID)
+        if done:
+            child_failed = yield ([agents[i] for i in done], new_rows, tasks[1:], plan + [task1], depth + 1, calling_stack)
+            child_failed = [position[a] for a in child_failed]
+            solved.update(set(done).difference(child_failed))
+            failed = sorted(failed + child_failed)
+        open_ = failed
+
+    task_checks = pyhop.checks_for(task1[0])
+    if task_checks and open_:
+        for check in task_checks:
+            pruned = _per_row(lambda state: check(state, task1, tasks, plan, depth, calling_stack),
+                              rows, open_, index, ID)
+            open_ = [i for i, prune in zip(open_, pruned) if not prune]
+            if not open_:
+                break
+
+    if task1[0] in pyhop.methods and open_:
+        relevant = pyhop.methods[task1[0]]
+        # Agents whose states give different method orders search separately
+        if task1[0][:len("produce_")] == "produce_" and pyhop.get_custom_method_order is not None:
+            orders = _per_row(lambda state: tuple(pyhop.reorder_methods(
+                state, task1, tasks, plan, depth, calling_stack, relevant)), rows, open_, index, ID)
+        else:
+            orders = [tuple(relevant)] * len(open_)
+        parts = {}
+        for i, order in zip(open_, orders):
+            parts.setdefault(order, []).append(i)
+
+        for order, part in parts.items():
+            for method in order:
+                if not part:
+                    break
+                results = _per_row(lambda state: method(state, *task1[1:]), rows, part, index, ID)
+                children = {}
+                still_open = []
+                for i, subtasks in zip(part, results):
+                    if subtasks == False:
+                        still_open.append(i)
+                    else:
+                        children.setdefault(tuple(subtasks), []).append(i)
+                for subtasks, members in children.items():
+                    child_failed = yield ([agents[i] for i in members], _take(rows, members, width),
+                                          list(subtasks) + tasks[1:], plan, depth + 1, calling_stack + [task1])
+                    child_failed = [position[a] for a in child_failed]
+                    solved.update(set(members).difference(child_failed))
+                    still_open.extend(child_failed)
+                part = sorted(still_open)
+
+    return [agent for i, agent in enumerate(agents) if i not in solved]
+
+if __name__ == '__main__':
+    import json
+    import random
+    import sys
+    import time
+
+    rules_filename = 'crafting.json'
+    if len(sys.argv) > 1:
+        rules_filename = sys.argv[1]
+    with open(rules_filename) as f:
+        data = json.load(f)
+
+    autoHTN.declare_operators(data)
+    autoHTN.declare_methods(data)
+    autoHTN.add_heuristic(data, ID)
+
+    # A crowd of agents after the same goal, with a little random stock
+    random.seed(0)
+    problems = [{'initial': {'plank': random.randint(0, 4), 'wood': random.randint(0, 2)},
+                 'goal': {'cart': 1, 'rail': 10}, 'time': random.randint(200, 300)}
+                for _ in range(200)]
+    index, rows, tasks = set_up_agents(data, problems)
+
+    t0 = time.perf_counter()
+    plans = plan_agents(index, rows, tasks)
+    t1 = time.perf_counter()
+    print('{} agents, {} planned in {:.4f} seconds'.format(
+        len(plans), sum(plan is not False for plan in plans), t1 - t0))
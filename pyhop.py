@@ -16,7 +16,10 @@ Copyright 2013 Dana S. Nau - http://www.cs.umd.edu/~nau
    See the License for the specific language governing permissions and
    limitations under the License.
    
-Pyhop should work correctly in both Python 2.7 and Python 3.2.
+This version of Pyhop needs Python 3.7 or later. Unlike the original,
+which ran on Python 2.7 and 3.2, it relies on dicts keeping insertion
+order, OrderedDict.move_to_end, time.perf_counter and
+ProcessPoolExecutor's initializer and mp_context arguments.
 For examples of how to use it, see the example files that come with Pyhop.
 
 Pyhop provides the following classes and functions:
@@ -29,6 +32,12 @@ Pyhop provides the following classes and functions:
   To put variables and values into it, you should do assignments such as
   bar.var1 = val1
 
+- foo = CompactState('foo', index, ID) creates a state whose variables all
+  have the form {ID: int}, stored in one flat integer array (all zeros, or
+  the array passed as values=). index maps each variable name to its slot
+  in that array. Read and write the variables the same way as with State,
+  e.g. foo.var1[ID] += 1.
+
 - print_state(foo) will print the variables and values in the state foo.
 
 - print_goal(foo) will print the variables and values in the goal foo.
@@ -55,6 +64,72 @@ Pyhop provides the following classes and functions:
 - if verbose = 1, it prints the initial parameters and the answer;
 - if verbose = 2, it also prints a message on each recursive call;
 - if verbose = 3, it also prints info about what it's computing.
+
+- pyhop(state1,tasklist,trail=True) searches without copying the state for
+  every operator. Operators that have the attribute trail_aware = True are
+  called as op(state,*args,trail=trail): they must change state in place
+  and, before each change, append (container, key, old_value) to trail so
+  that Pyhop can undo it with container[key] = old_value on backtracking.
+  Other operators still get a deep copy of the state. The state passed to
+  pyhop is copied once and left untouched.
+
+- pyhop(state1,tasklist,engine='iterative') runs the same search with an
+  explicit stack of choice points instead of one Python call per task, so
+  long plans aren't limited by Python's recursion limit. It returns exactly
+  the plan that the default engine='recursive' returns.
+
+- pyhop(state1,tasklist,engine='parallel') splits the search into the
+  subtrees below the first few choice points and searches them in a pool
+  of worker processes, still returning the plan the other engines return.
+  For the pool size and the number of subtrees, call seek_plan_parallel.
+
+- During the search the remaining tasks are an Agenda and the plan and
+  calling stack are Paths: persistent lists that share their tails, so a
+  search step doesn't copy them. Checks and method orderings get these as
+  read-only sequences, and plans are returned as lists.
+
+- add_check(f) prunes every search node for which f(state, task1, tasks,
+  plan, depth, calling_stack) is True; add_check(f, names, prefixes) only
+  calls f for tasks with one of those names or name prefixes.
+  in_calling_stack(calling_stack, name) tells f in O(1) whether a task
+  named name is being decomposed above the node.
+
+- define_ordering(f, key) reorders the methods of produce_* tasks with
+  f(state, task1, tasks, plan, depth, calling_stack, methods). With key,
+  the order is computed once per task and key(state, task1) and kept in
+  method_orders, a bounded cache.
+
+- pyhop(state1,tasklist,nogoods=NogoodTable()) remembers the search nodes
+  that turned out to have no plan and fails immediately when it meets one
+  of them again. A node is identified by the state, the remaining tasks and
+  the set of task names on the calling stack, so checks may look at those
+  but shouldn't depend on anything else. A check that looks at the depth
+  must be added with add_check(f, depth=True); nodes above one it prunes
+  aren't remembered.
+  nogoods=DominanceTable() also fails a node whose state has no more of
+  anything than a failed one with the same tasks, for domains where having
+  more never hurts.
+
+- pyhop(state1,tasklist,stats=SearchStats()) fills in statistics about the
+  search: expansions per task name, backtracks per method, prunes per check,
+  operator failures, the greatest depth and (with timing=True) the time
+  spent copying states, evaluating methods and running checks.
+  print(stats.summary()) shows the busiest entries.
+
+- iter_plans(state1,tasklist) is a generator over the distinct plans for
+  tasklist, starting with the one pyhop returns; each next plan continues the
+  same search. best_plans(state1,tasklist,k,cost,max_plans) picks the k
+  cheapest of the first max_plans of them.
+
+- branch_and_bound(state1,tasklist,cost,lower_bound,stop) keeps searching
+  after the first plan and yields (plan, cost) each time it finds a cheaper
+  one, skipping partial plans whose lower bound is no better. stop() ends
+  the search early, e.g. when a time or node budget runs out.
+
+- Replanner(tasklist).plan(state1) plans tasklist and remembers the tasks
+  still open after each action; after the state changes, calling .plan
+  again keeps the part of the last plan that still works and only plans the
+  tasks left open after it.
 """
 
 # Pyhop's planning algorithm is very similar to the one in SHOP and JSHOP
@@ -97,6 +172,12 @@ Pyhop provides the following classes and functions:
 
 from __future__ import print_function
 import copy,sys, pprint
+import heapq, itertools, multiprocessing, os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from time import perf_counter
 
 ############################################################
 # States and goals
@@ -106,6 +187,90 @@ class State():
     def __init__(self,name):
         self.__name__ = name
 
+class CompactState(object):
+    """
+    A state for a single agent ID whose variables are all integer counts.
+    index maps each variable name to a slot in the flat array values; it
+    is built once per domain and shared by every copy of the state, so
+    copying a CompactState only copies the array.
+    """
+    __slots__ = ('__name__', 'index', 'ID', 'values')
+
+    def __init__(self, name, index, ID, values=None):
+        self.__name__ = name
+        self.index = index
+        self.ID = ID
+        self.values = array('i', [0]) * len(index) if values is None else values
+
+    def __getattr__(self, var):
+        # Only reached for names that aren't slots, i.e. state variables.
+        if var.startswith('__') or var in CompactState.__slots__:
+            raise AttributeError(var)
+        try:
+            return _Slot(self, self.index[var])
+        except KeyError:
+            raise AttributeError(var)
+
+    def __setattr__(self, var, value):
+        if var in CompactState.__slots__:
+            object.__setattr__(self, var, value)
+        else:
+            self.values[self.index[var]] = value[self.ID]
+
+    def __copy__(self):
+        new = object.__new__(CompactState)
+        object.__setattr__(new, '__name__', self.__name__)
+        object.__setattr__(new, 'index', self.index)
+        object.__setattr__(new, 'ID', self.ID)
+        object.__setattr__(new, 'values', self.values[:])
+        return new
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    def __reduce__(self):
+        return (_compact_state, (self.__name__, self.index, self.ID, self.values))
+
+    def variables(self):
+        """Return (name, {ID: value}) pairs in slot order, like vars(State)."""
+        return [(var, {self.ID: self.values[slot]})
+                for var, slot in sorted(self.index.items(), key=lambda kv: kv[1])]
+
+# Index dicts by content, so that a CompactState sent to another process
+# gets back the very index object its domain's operators compare with 'is'
+_shared_indexes = {}
+
+def share_index(index):
+    """Make unpickled CompactStates with this index's contents use index itself."""
+    _shared_indexes[tuple(index.items())] = index
+
+def _compact_state(name, index, ID, values):
+    return CompactState(name, _shared_indexes.get(tuple(index.items()), index), ID, values)
+
+class _Slot(object):
+    """The {ID: value} view that CompactState returns for one variable."""
+    __slots__ = ('state', 'slot')
+
+    def __init__(self, state, slot):
+        self.state = state
+        self.slot = slot
+
+    def __getitem__(self, ID):
+        if ID != self.state.ID:
+            raise KeyError(ID)
+        return self.state.values[self.slot]
+
+    def __setitem__(self, ID, value):
+        if ID != self.state.ID:
+            raise KeyError(ID)
+        self.state.values[self.slot] = value
+
+    def __eq__(self, other):
+        return {self.state.ID: self.state.values[self.slot]} == other
+
+    def __repr__(self):
+        return repr({self.state.ID: self.state.values[self.slot]})
+
 class Goal():
     """A goal is just a collection of variable bindings."""
     def __init__(self,name):
@@ -117,7 +282,11 @@ class Goal():
 def print_state(state,indent=4):
     """Print each variable in state, indented by indent spaces."""
     if state != False:
-        for (name,val) in vars(state).items():
+        if isinstance(state, CompactState):
+            variables = state.variables()
+        else:
+            variables = vars(state).items()
+        for (name,val) in variables:
             if name != '__name__':
                 for x in range(indent): sys.stdout.write(' ')
                 sys.stdout.write(state.__name__ + '.' + name)
@@ -134,6 +303,441 @@ def print_goal(goal,indent=4):
                 print(' =', val)
     else: print('False')
 
+def state_key(state):
+    """A hashable snapshot of every variable in state."""
+    if isinstance(state, CompactState):
+        return state.values.tobytes()
+    return tuple((name, _freeze(val)) for (name, val) in sorted(vars(state).items())
+                 if name != '__name__')
+
+def _freeze(val):
+    if isinstance(val, dict):
+        return tuple(sorted((k, _freeze(v)) for (k, v) in val.items()))
+    if isinstance(val, (list, tuple)):
+        return tuple(_freeze(v) for v in val)
+    return val
+
+############################################################
+# Persistent lists for the agenda, the plan and the calling stack
+
+class _Persistent(object):
+    """
+    Immutable list made of (item, next cell) pairs. Lists made from one
+    another share their cells, so the search adds or removes an item in
+    O(1) instead of copying the whole list. Checks and method orderings see
+    them as read-only sequences: len, iteration, indexing, 'in' and == work
+    as for lists, and slicing or + give a new plain list.
+    """
+    __slots__ = ('cell', 'size')
+
+    def __init__(self, items=()):
+        cell = None
+        for item in self._cell_order(items):
+            cell = (item, cell)
+        self.cell = cell
+        self.size = len(items)
+
+    @classmethod
+    def _make(cls, cell, size):
+        new = object.__new__(cls)
+        new.cell = cell
+        new.size = size
+        return new
+
+    def _cells(self):
+        """The items from the first cell on."""
+        cell = self.cell
+        while cell is not None:
+            yield cell[0]
+            cell = cell[1]
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.cell is not None
+
+    __nonzero__ = __bool__
+
+    def __contains__(self, item):
+        for x in self._cells():
+            if x == item:
+                return True
+        return False
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('list index out of range')
+        return self._at(i)
+
+    def __eq__(self, other):
+        try:
+            if len(other) != self.size:
+                return False
+        except TypeError:
+            return NotImplemented
+        return all(x == y for (x, y) in zip(self, other))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __reduce__(self):
+        # as a list, so pickling a long plan doesn't recurse once per cell
+        return (type(self), (list(self),))
+
+class Agenda(_Persistent):
+    """Persistent list of tasks whose first cell is its first task."""
+    __slots__ = ()
+
+    @staticmethod
+    def _cell_order(items):
+        return reversed(items)
+
+    def __iter__(self):
+        return self._cells()
+
+    def _at(self, i):
+        cell = self.cell
+        for _ in range(i):
+            cell = cell[1]
+        return cell[0]
+
+    @property
+    def rest(self):
+        """The agenda without its first task."""
+        return Agenda._make(self.cell[1], self.size - 1)
+
+    def push(self, tasks):
+        """The agenda with the list tasks in front of it."""
+        cell = self.cell
+        for task in reversed(tasks):
+            cell = (task, cell)
+        return Agenda._make(cell, self.size + len(tasks))
+
+class Path(_Persistent):
+    """
+    Persistent list that grows at the end, like a plan or a calling stack.
+    Its first cell is its last item, so iterating in order costs a list of
+    its items; reversed() doesn't.
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def _cell_order(items):
+        return items
+
+    def __iter__(self):
+        items = list(self._cells())
+        items.reverse()
+        return iter(items)
+
+    def __reversed__(self):
+        return self._cells()
+
+    def _at(self, i):
+        cell = self.cell
+        for _ in range(self.size - 1 - i):
+            cell = cell[1]
+        return cell[0]
+
+    def append(self, item):
+        """The path with item added at the end."""
+        return Path._make((item, self.cell), self.size + 1)
+
+class CallingStack(Path):
+    """
+    Path of the tasks being decomposed above a search node. Each cell also
+    holds a dict of how many tasks of each name it and the cells below it
+    hold, so asking whether a task name is on the stack is a dict lookup.
+    """
+    __slots__ = ()
+
+    def __init__(self, items=()):
+        self.cell = None
+        self.size = 0
+        for item in items:
+            self.cell = self.append(item).cell
+            self.size += 1
+
+    @property
+    def names(self):
+        """Task name -> how many tasks of that name are on the stack."""
+        return self.cell[2] if self.cell is not None else {}
+
+    def append(self, task):
+        """The stack with task pushed on top."""
+        names = dict(self.names)
+        names[task[0]] = names.get(task[0], 0) + 1
+        return CallingStack._make((task, self.cell, names), self.size + 1)
+
+def in_calling_stack(calling_stack, task_name):
+    """
+    True if a task named task_name is on calling_stack. This takes O(1) for
+    the CallingStack that checks get from the search, and scans a list.
+    """
+    if type(calling_stack) is CallingStack:
+        return task_name in calling_stack.names
+    for task in calling_stack:
+        if task[0] == task_name:
+            return True
+    return False
+
+############################################################
+# Remembering failures
+
+class NogoodTable(object):
+    """
+    The search nodes known to have no plan, keyed by node_key(). Holds at
+    most max_entries keys and forgets the least recently used one when it is
+    full. hits, misses and evictions count lookups and forgotten keys.
+    """
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key):
+        self.entries[key] = True
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def key(self, state, tasks, calling_stack):
+        """The key the search looks up and adds for a node."""
+        return node_key(state, tasks, calling_stack)
+
+class DominanceTable(NogoodTable):
+    """
+    A NogoodTable that also knows a node fails if a node with the same
+    tasks and calling stack names failed in a state with at least as much
+    of everything. That only holds in domains where more of any variable
+    never stops a plan from working, as in crafting. It only applies to
+    CompactStates with no negative counts; other states are matched
+    exactly.
+
+    For each agenda it keeps the (inventory, time) vectors of its failed
+    states. They mostly trade one variable for the others (more time left
+    or more items made), so they are put in buckets by the value of the
+    axis variable, and each bucket is sorted by the total of the other
+    variables, largest first (negated, for bisect). A lookup only visits
+    the buckets with at least the state's axis value, and in each only the
+    vectors with at least its total. Each vector is packed into one int,
+    64 bits per variable, so comparing two is one subtraction: with a
+    guard bit added to every field of the failed vector, subtracting the
+    new one clears the guard of any field where the new state has more.
+    Vectors that a later failure has more of everything than are left in;
+    a depth-first search hardly ever makes them. max_entries bounds the
+    number of agendas.
+    """
+    def __init__(self, max_entries=100000, axis='time'):
+        NogoodTable.__init__(self, max_entries)
+        self.axis = axis
+        self.guards = {}    # number of variables -> the guard bits
+
+    def __contains__(self, key):
+        agenda, values = key
+        frontier = self.entries.get(agenda)
+        if frontier is not None:
+            if type(frontier) is set:
+                found = values in frontier
+            else:
+                found = self._dominated(frontier, values, self.guards[agenda[0]])
+            if found:
+                self.entries.move_to_end(agenda)
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def _dominated(self, frontier, values, guards):
+        axis_value, total, packed = values
+        axis_values, buckets = frontier
+        for v in itertools.islice(axis_values, bisect_left(axis_values, axis_value), None):
+            totals, failed = buckets[v]
+            for f in itertools.islice(failed, bisect_right(totals, -total)):
+                if (f + guards - packed) & guards == guards:
+                    return True
+        return False
+
+    def __len__(self):
+        return sum(len(frontier) if type(frontier) is set else
+                   sum(len(failed) for (totals, failed) in frontier[1].values())
+                   for frontier in self.entries.values())
+
+    def add(self, key):
+        agenda, values = key
+        if not agenda[0]:
+            self.entries.setdefault(agenda, set()).add(values)
+        else:
+            axis_value, total, packed = values
+            frontier = self.entries.get(agenda)
+            if frontier is None:
+                frontier = self.entries[agenda] = ([], {})
+            axis_values, buckets = frontier
+            if axis_value not in buckets:
+                axis_values.insert(bisect_left(axis_values, axis_value), axis_value)
+                buckets[axis_value] = ([], [])
+            totals, failed = buckets[axis_value]
+            i = bisect_left(totals, -total)
+            totals.insert(i, -total)
+            failed.insert(i, packed)
+        self.entries.move_to_end(agenda)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def key(self, state, tasks, calling_stack):
+        if type(calling_stack) is CallingStack:
+            names = frozenset(calling_stack.names)
+        else:
+            names = frozenset(task[0] for task in calling_stack)
+        # The agenda part starts with the number of variables, 0 if the
+        # state can only be matched exactly
+        values = state.values if isinstance(state, CompactState) else ()
+        if values and min(values) >= 0:
+            n = len(values)
+            if n not in self.guards:
+                self.guards[n] = int.from_bytes(array('q', [1 << 62]).tobytes() * n, 'little')
+            slot = state.index.get(self.axis)
+            axis_value = values[slot] if slot is not None else 0
+            return ((n, tuple(tasks), names),
+                    (axis_value, sum(values) - axis_value, int.from_bytes(array('q', values).tobytes(), 'little')))
+        return ((0, tuple(tasks), names), state_key(state))
+
+def node_key(state, tasks, calling_stack):
+    """Key of the search node for tasks in state under calling_stack."""
+    if type(calling_stack) is CallingStack:
+        return (state_key(state), tuple(tasks), frozenset(calling_stack.names))
+    return (state_key(state), tuple(tasks), frozenset(task[0] for task in calling_stack))
+
+############################################################
+# Search statistics
+
+class SearchStats(object):
+    """
+    Counters that the planner fills in when pyhop is given stats=SearchStats().
+    Counting only costs a few dict updates per node. The timers call
+    perf_counter around every copy, method and check, so they are off unless
+    timing=True.
+    """
+    def __init__(self, timing=False):
+        self.timing = timing
+        self.nodes = 0                                # search nodes expanded
+        self.backtracks = 0                           # nodes for which every alternative failed
+        self.max_depth = 0
+        self.expansions = defaultdict(int)            # task name -> nodes expanded
+        self.method_backtracks = defaultdict(int)     # method name -> subtasks that led nowhere
+        self.method_rejections = defaultdict(int)     # method name -> times it returned False
+        self.check_prunes = defaultdict(int)          # check name -> branches it pruned
+        self.operator_failures = defaultdict(int)     # operator name -> times it returned False
+        self.copy_time = 0.0                          # seconds in copy.deepcopy(state)
+        self.method_time = 0.0                        # seconds in methods
+        self.check_time = 0.0                         # seconds in checks
+
+    def as_dict(self):
+        return {name: dict(val) if isinstance(val, dict) else val
+                for (name, val) in vars(self).items()}
+
+    def add(self, other):
+        """Add the counts and times of other, e.g. from another process, to these."""
+        self.nodes += other.nodes
+        self.backtracks += other.backtracks
+        self.max_depth = max(self.max_depth, other.max_depth)
+        for name in ('expansions', 'method_backtracks', 'method_rejections', 'check_prunes', 'operator_failures'):
+            table = getattr(self, name)
+            for key, count in getattr(other, name).items():
+                table[key] += count
+        self.copy_time += other.copy_time
+        self.method_time += other.method_time
+        self.check_time += other.check_time
+
+    def summary(self, top=5):
+        """A few lines with the totals and the top entries of each table."""
+        lines = ['nodes {}  backtracks {}  max depth {}'.format(self.nodes, self.backtracks, self.max_depth)]
+        if self.timing:
+            lines.append('copy {:.4f}s  methods {:.4f}s  checks {:.4f}s'.format(
+                self.copy_time, self.method_time, self.check_time))
+        for title, table in (('expansions', self.expansions),
+                             ('method backtracks', self.method_backtracks),
+                             ('method rejections', self.method_rejections),
+                             ('check prunes', self.check_prunes),
+                             ('operator failures', self.operator_failures)):
+            if table:
+                busiest = sorted(table.items(), key=lambda kv: -kv[1])[:top]
+                lines.append('{}: {}'.format(title, ', '.join('{} {}'.format(k, v) for (k, v) in busiest)))
+        return '\n'.join(lines)
+
+def _copy_state(state, stats):
+    if stats is None or not stats.timing:
+        return copy.deepcopy(state)
+    t0 = perf_counter()
+    newstate = copy.deepcopy(state)
+    stats.copy_time += perf_counter() - t0
+    return newstate
+
+def _apply_method(method, state, task1, stats):
+    if stats is None:
+        return method(state,*task1[1:])
+    if stats.timing:
+        t0 = perf_counter()
+        subtasks = method(state,*task1[1:])
+        stats.method_time += perf_counter() - t0
+    else:
+        subtasks = method(state,*task1[1:])
+    if subtasks == False:
+        stats.method_rejections[method.__name__] += 1
+    return subtasks
+
+def _pruned(state, task1, tasks, plan, depth, calling_stack, stats):
+    """True if one of the checks for task1 prunes this node."""
+    global depth_cuts
+    if stats is None:
+        for check in checks_for(task1[0]):
+            if check(state, task1, tasks, plan, depth, calling_stack):
+                if check in depth_checks: depth_cuts += 1
+                return True
+        return False
+    t0 = perf_counter() if stats.timing else 0
+    for check in checks_for(task1[0]):
+        if check(state, task1, tasks, plan, depth, calling_stack):
+            if check in depth_checks: depth_cuts += 1
+            stats.check_prunes[check.__name__] += 1
+            if stats.timing: stats.check_time += perf_counter() - t0
+            return True
+    if stats.timing: stats.check_time += perf_counter() - t0
+    return False
+
 ############################################################
 # Helper functions that may be useful in domain models
 
@@ -173,22 +777,119 @@ def declare_methods(task_name, *method_list):
     method_list must be a list of functions, not strings.
     """
     methods.update({task_name:list(method_list)})
+    method_orders.clear()
     return methods[task_name]
 
 # start cm146 modification
 checks = []
-def add_check(func):
+# check -> (task names, task name prefixes) it runs for; checks that aren't
+# here run for every task
+check_tasks = {}
+_checks_by_task = {}
+# The checks that look at the depth, and how many nodes they have pruned.
+# A node is only remembered as a failure if none were pruned below it,
+# since the same node may have a plan when it comes up less deep.
+depth_checks = set()
+depth_cuts = 0
+
+def add_check(func, names=None, prefixes=None, depth=False):
+    """
+    Add func to the checks. With names (task names) or prefixes (task name
+    prefixes), func only runs for tasks that match one of them; otherwise
+    it runs for every task. depth=True says func looks at the depth (a
+    depth cutoff), so the nodes above those it prunes aren't remembered
+    in a NogoodTable.
+    """
     checks.append(func)
+    if names is not None or prefixes is not None:
+        check_tasks[func] = (frozenset(names or ()), tuple(prefixes or ()))
+    if depth:
+        depth_checks.add(func)
+    _checks_by_task.clear()
+
+def clear_checks():
+    """Remove every check."""
+    del checks[:]
+    check_tasks.clear()
+    depth_checks.clear()
+    _checks_by_task.clear()
+
+def checks_for(task_name):
+    """The checks that run for tasks named task_name, in the order they were added."""
+    found = _checks_by_task.get(task_name)
+    if found is None:
+        found = []
+        for check in checks:
+            if check not in check_tasks:
+                found.append(check)
+                continue
+            names, prefixes = check_tasks[check]
+            if task_name in names or task_name.startswith(prefixes):
+                found.append(check)
+        _checks_by_task[task_name] = found
+    return found
 
 get_custom_method_order = None
-def define_ordering(func):
-    global get_custom_method_order
+get_ordering_key = None
+
+class MethodOrders(object):
+    """
+    The method orders found by get_custom_method_order, keyed by (task,
+    get_ordering_key(state, task)). Holds at most max_entries orders and
+    forgets the least recently used one when it is full.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        order = self.entries.get(key)
+        if order is None:
+            self.misses += 1
+        else:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return order
+
+    def add(self, key, order):
+        self.entries[key] = order
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+method_orders = MethodOrders()
+
+def define_ordering(func, key=None, max_entries=10000):
+    """
+    func(state, task1, tasks, plan, depth, calling_stack, methods) returns
+    the methods for a produce_* task in the order to try them. If the order
+    only depends on a few features of the state, pass key(state, task1)
+    returning those features (hashable, e.g. the tools owned and the time
+    left rounded down): func is then only called once per task and key,
+    and the order is looked up for every later node with the same ones.
+    """
+    global get_custom_method_order, get_ordering_key, method_orders
     get_custom_method_order = func
+    get_ordering_key = key
+    method_orders = MethodOrders(max_entries)
 
 def reorder_methods(state, task1, tasks, plan, depth, calling_stack, methods):
     if get_custom_method_order is None:
         return methods
-    new_methods = get_custom_method_order(state, task1, tasks, plan, depth, calling_stack, copy.deepcopy(methods))
+    if get_ordering_key is not None:
+        key = (task1, get_ordering_key(state, task1))
+        new_methods = method_orders.get(key)
+        if new_methods is None:
+            new_methods = get_custom_method_order(state, task1, tasks, plan, depth, calling_stack, list(methods))
+            method_orders.add(key, new_methods)
+        return new_methods
+    new_methods = get_custom_method_order(state, task1, tasks, plan, depth, calling_stack, list(methods))
     # for i, method in enumerate(methods):
     #     if method not in new_methods:
     #         print(f'ERROR: method ordering cannot be changed from:\n' +
@@ -205,6 +906,12 @@ def reorder_methods(state, task1, tasks, plan, depth, calling_stack, methods):
     #         return methods
     return new_methods
 
+def undo_trail(trail, mark):
+    """Undo the changes recorded on trail since len(trail) was mark."""
+    while len(trail) > mark:
+        container, key, old = trail.pop()
+        container[key] = old
+
 def get_subtasks(method, state, curr_task):
     return method(state,*curr_task[1:])
 # end cm146 modification
@@ -225,47 +932,89 @@ def print_methods(mlist=methods):
 ############################################################
 # The actual planner
 
-def pyhop(state,tasks,verbose=0):
+engines = {}
+
+def pyhop(state,tasks,verbose=0,trail=False,engine='recursive',nogoods=None,stats=None):
     """
     Try to find a plan that accomplishes tasks in state. 
     If successful, return the plan. Otherwise return False.
+    If trail is True, trail-aware operators change one copy of state in
+    place and their changes are undone on backtracking.
+    engine is 'recursive' (seek_plan), 'iterative' (seek_plan_iterative)
+    or 'parallel' (seek_plan_parallel).
+    nogoods is a NogoodTable to record failed nodes in, or None.
+    stats is a SearchStats to count the search in, or None.
     """
+    if engine not in engines:
+        raise ValueError('unknown engine {!r}, expected one of {}'.format(engine, sorted(engines)))
     if verbose>0: print('** pyhop, verbose={}: **\n   state = {}\n   tasks = {}'.format(verbose, state.__name__, tasks))
-    result = seek_plan(state,tasks,[],0,verbose)
+    if trail:
+        result = engines[engine](copy.deepcopy(state),tasks,[],0,verbose,trail=[],nogoods=nogoods,stats=stats)
+    else:
+        result = engines[engine](state,tasks,[],0,verbose,nogoods=nogoods,stats=stats)
     if verbose>0: print('** result =',result,'\n')
     return result
 
 # cm146 modification: add calling stack as parameter
-def seek_plan(state,tasks,plan,depth,verbose=0,calling_stack=[]):
+def seek_plan(state,tasks,plan,depth,verbose=0,calling_stack=[],trail=None,nogoods=None,stats=None):
     """
     Workhorse for pyhop. state and tasks are as in pyhop.
     - plan is the current partial plan.
     - depth is the recursion depth, for use in debugging
     - verbose is whether to print debugging messages
+    - trail is the undo trail, or None to deep-copy state for every operator
+    - nogoods is a NogoodTable of nodes known to fail, or None
+    - stats is a SearchStats to count the search in, or None
+    tasks, plan and calling_stack may be lists; they are searched as an
+    Agenda and Paths, and the plan comes back as a list.
     # """
+    if type(plan) is not Path:
+        solution = seek_plan(state,Agenda(tasks),Path(plan),depth,verbose,CallingStack(calling_stack),trail,nogoods,stats)
+        return solution if solution is False else list(solution)
     # print (tasks)
     if verbose>1: print('depth {} tasks {}'.format(depth,tasks))
-    if tasks == []:
+    if not tasks:
         if verbose>2: print('depth {} returns plan {}'.format(depth,plan))
         return plan
     task1 = tasks[0]
+    if stats is not None:
+        stats.nodes += 1
+        stats.expansions[task1[0]] += 1
+        if depth > stats.max_depth: stats.max_depth = depth
+    if nogoods is not None:
+        key = nogoods.key(state,tasks,calling_stack)
+        if key in nogoods:
+            if verbose>2: print('depth {} returns known failure'.format(depth))
+            if stats is not None: stats.backtracks += 1
+            return False
+        cuts = depth_cuts
 
     if task1[0] in operators:
         if verbose>2: print('depth {} action {}'.format(depth,task1))
         operator = operators[task1[0]]
-        newstate = operator(copy.deepcopy(state),*task1[1:])
+        if trail is not None and getattr(operator,'trail_aware',False):
+            mark = len(trail)
+            newstate = operator(state,*task1[1:],trail=trail)
+        else:
+            mark = None
+            newstate = operator(_copy_state(state,stats),*task1[1:])
         if verbose>2:
             print('depth {} new state:'.format(depth))
             print_state(newstate)
+        if not newstate and stats is not None:
+            stats.operator_failures[task1[0]] += 1
         if newstate:
-            solution = seek_plan(newstate,tasks[1:],plan+[task1],depth+1,verbose,calling_stack)
+            solution = seek_plan(newstate,tasks.rest,plan.append(task1),depth+1,verbose,calling_stack,trail,nogoods,stats)
             if solution != False:
                 return solution
+        if mark is not None:
+            undo_trail(trail, mark)
 
     # start cm146 modification
-    for check in checks:
-        if check(state, task1, tasks, plan, depth, calling_stack):
-            return False
+    if _pruned(state, task1, tasks, plan, depth, calling_stack, stats):
+        if nogoods is not None and depth_cuts == cuts: nogoods.add(key)
+        if stats is not None: stats.backtracks += 1
+        return False
     # end cm146 modification
 
     if task1[0] in methods:
@@ -276,13 +1025,379 @@ def seek_plan(state,tasks,plan,depth,verbose=0,calling_stack=[]):
             relevant = reorder_methods(state, task1, tasks, plan, depth, calling_stack, relevant)
         # end cm146 modification
         for method in relevant:
-            subtasks = method(state,*task1[1:])
+            subtasks = _apply_method(method,state,task1,stats)
             if verbose>2:
                 print('depth {} new tasks: {}'.format(depth,subtasks))
             # Can't just say "if subtasks:", because that's wrong if subtasks == []
             if subtasks != False:
-                solution = seek_plan(state,subtasks+tasks[1:],plan,depth+1,verbose,calling_stack+[task1])
+                solution = seek_plan(state,tasks.rest.push(subtasks),plan,depth+1,verbose,calling_stack.append(task1),trail,nogoods,stats)
                 if solution != False:
                     return solution
+                if stats is not None: stats.method_backtracks[method.__name__] += 1
     if verbose>2: print('depth {} returns failure'.format(depth))
+    if nogoods is not None and depth_cuts == cuts: nogoods.add(key)
+    if stats is not None: stats.backtracks += 1
     return False
+
+engines['recursive'] = seek_plan
+
+############################################################
+# The same planner without recursion
+
+def seek_plan_iterative(state,tasks,plan,depth,verbose=0,calling_stack=[],trail=None,nogoods=None,stats=None):
+    """
+    Same arguments and result as seek_plan, but the search keeps its choice
+    points on an explicit stack, so the plan length is not limited by
+    Python's recursion limit.
+    """
+    for solution in search(state,tasks,plan,depth,verbose,calling_stack,trail,nogoods,stats):
+        return solution
+    return False
+
+engines['iterative'] = seek_plan_iterative
+
+############################################################
+# Searching subtrees in parallel
+
+def seek_plan_parallel(state,tasks,plan,depth,verbose=0,calling_stack=[],trail=None,nogoods=None,stats=None,processes=None,width=None):
+    """
+    Same arguments and result as seek_plan, but the subtrees below the first
+    choice points are searched at the same time by processes worker
+    processes (one per core by default). The nodes nearest the root are
+    expanded, in seek_plan's order, until there are at least width subtrees
+    (4 per process by default). The plan of a subtree is only returned once
+    every subtree to its left has failed, so the result is the plan that
+    seek_plan finds; as soon as a subtree has a plan, the ones to its right
+    are cancelled. The workers are forked, so they use the operators,
+    methods and checks declared in this process; where fork isn't available
+    this is seek_plan_iterative. trail is ignored, and with nogoods every
+    subtree gets a new table of the same class.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return seek_plan_iterative(state,tasks,plan,depth,verbose,calling_stack,None,nogoods,stats)
+    processes = processes or os.cpu_count() or 1
+    width = width or 4 * processes
+
+    # Expand whole levels so the subtrees stay in seek_plan's order
+    frontier = [(state,Agenda(tasks),Path(plan),depth,CallingStack(calling_stack))]
+    while len(frontier) < width and any(node[1] for node in frontier):
+        grown = []
+        for node in frontier:
+            if not node[1]:
+                grown.append(node)
+                continue
+            if stats is not None:
+                stats.nodes += 1
+                stats.expansions[node[1][0][0]] += 1
+            grown.extend(expand(node[0],node[1],node[2],node[3],verbose,node[4],None,stats))
+        frontier = grown
+    if verbose>1: print('searching {} subtrees in {} processes'.format(len(frontier),processes))
+
+    results = {}
+    for i,node in enumerate(frontier):
+        if not node[1]:
+            results[i] = list(node[2])
+    done,solution = _leftmost(results,len(frontier))
+    if done:
+        return solution
+
+    context = multiprocessing.get_context('fork')
+    cancelled = context.RawArray('b',len(frontier))
+    with ProcessPoolExecutor(processes,mp_context=context,initializer=_init_subtree_worker,initargs=(cancelled,)) as pool:
+        jobs = [pool.submit(_search_subtree,i,node,type(nogoods) if nogoods is not None else None,stats is not None)
+                for i,node in enumerate(frontier) if i not in results]
+        for job in as_completed(jobs):
+            i,subtree_plan,subtree_stats = job.result()
+            results[i] = subtree_plan
+            if subtree_stats is not None:
+                stats.add(subtree_stats)
+            if subtree_plan is not False:
+                for j in range(i+1,len(frontier)):
+                    cancelled[j] = 1
+            done,solution = _leftmost(results,len(frontier))
+            if done:
+                break
+        for j in range(len(frontier)):
+            cancelled[j] = 1
+        for job in jobs:
+            job.cancel()
+    return solution
+
+engines['parallel'] = seek_plan_parallel
+
+def _leftmost(results,count):
+    """(True, plan or False) once results decide the leftmost plan, else (False, None)."""
+    for i in range(count):
+        if i not in results:
+            return False,None
+        if results[i] is not False:
+            return True,results[i]
+    return True,False
+
+# Set in each worker process: cancelled[i] is 1 once subtree i isn't needed
+_cancelled = None
+
+def _init_subtree_worker(cancelled):
+    global _cancelled
+    _cancelled = cancelled
+
+def _search_subtree(i,node,nogoods_class,use_stats):
+    state,tasks,plan,depth,calling_stack = node
+    stats = SearchStats() if use_stats else None
+    nogoods = nogoods_class() if nogoods_class is not None else None
+    for solution in search(state,tasks,plan,depth,0,calling_stack,None,nogoods,stats,stop=lambda: _cancelled[i]):
+        return i,solution,stats
+    return i,False,stats
+
+def iter_plans(state,tasks,verbose=0,trail=False,stats=None):
+    """
+    Generator over the distinct plans for tasks, in the order the depth-first
+    search finds them; the first one is the plan pyhop returns. The search
+    resumes from where it stopped each time the next plan is asked for, and
+    stops when the caller stops asking. There is no nogoods argument: a node
+    that failed to give a new plan may still give new plans after another
+    prefix.
+    """
+    if trail:
+        state,trail = copy.deepcopy(state),[]
+    else:
+        trail = None
+    seen = set()
+    for plan in search(state,tasks,[],0,verbose,[],trail,None,stats):
+        key = tuple(plan)
+        if key not in seen:
+            seen.add(key)
+            yield plan
+
+def search(state,tasks,plan,depth,verbose=0,calling_stack=[],trail=None,nogoods=None,stats=None,prune=None,stop=None):
+    """
+    Generator over the plans for tasks, in the order seek_plan's depth-first
+    search reaches them. The stack holds one expand() generator per task
+    being worked on, with the node's nogood key; each generator produces the
+    alternatives for its task lazily, exactly when seek_plan would try them.
+    - prune(state,tasks,plan) is called at every node and skips it if True
+    - stop() is called at every node and ends the search if True
+    tasks, plan and calling_stack may be lists; plans are yielded as lists.
+    """
+    if type(plan) is not Path:
+        tasks,plan,calling_stack = Agenda(tasks),Path(plan),CallingStack(calling_stack)
+    node = (state,tasks,plan,depth,calling_stack)
+    stack = []
+    while True:
+        state,tasks,plan,depth,calling_stack = node
+        if verbose>1: print('depth {} tasks {}'.format(depth,tasks))
+        if not tasks:
+            if verbose>2: print('depth {} returns plan {}'.format(depth,plan))
+            yield list(plan)
+        else:
+            key = None
+            if nogoods is not None:
+                key = nogoods.key(state,tasks,calling_stack)
+            if stats is not None:
+                stats.nodes += 1
+                stats.expansions[tasks[0][0]] += 1
+                if depth > stats.max_depth: stats.max_depth = depth
+            if stop is not None and stop():
+                if verbose>2: print('depth {} stops the search'.format(depth))
+                return
+            if key is not None and key in nogoods:
+                if verbose>2: print('depth {} returns known failure'.format(depth))
+                if stats is not None: stats.backtracks += 1
+            elif prune is not None and prune(state,tasks,plan):
+                if verbose>2: print('depth {} is pruned'.format(depth))
+                if stats is not None: stats.backtracks += 1
+            else:
+                stack.append((expand(state,tasks,plan,depth,verbose,calling_stack,trail,stats), key, depth_cuts))
+        node = None
+        while stack and node is None:
+            node = next(stack[-1][0], None)
+            if node is None:
+                # every alternative for this task failed: backtrack
+                _, key, cuts = stack.pop()
+                if key is not None and depth_cuts == cuts: nogoods.add(key)
+                if stats is not None: stats.backtracks += 1
+        if node is None:
+            return
+
+def expand(state,tasks,plan,depth,verbose,calling_stack,trail,stats=None):
+    """
+    Generator over the children of one search node, as tuples
+    (state, tasks, plan, depth, calling_stack), in seek_plan's order: the
+    operator for tasks[0] if there is one, then each applicable method.
+    tasks is an Agenda and plan and calling_stack are Paths.
+    """
+    task1 = tasks[0]
+
+    if task1[0] in operators:
+        if verbose>2: print('depth {} action {}'.format(depth,task1))
+        operator = operators[task1[0]]
+        if trail is not None and getattr(operator,'trail_aware',False):
+            mark = len(trail)
+            newstate = operator(state,*task1[1:],trail=trail)
+        else:
+            mark = None
+            newstate = operator(_copy_state(state,stats),*task1[1:])
+        if verbose>2:
+            print('depth {} new state:'.format(depth))
+            print_state(newstate)
+        if not newstate and stats is not None:
+            stats.operator_failures[task1[0]] += 1
+        if newstate:
+            yield (newstate,tasks.rest,plan.append(task1),depth+1,calling_stack)
+        if mark is not None:
+            undo_trail(trail, mark)
+
+    if _pruned(state, task1, tasks, plan, depth, calling_stack, stats):
+        return
+
+    if task1[0] in methods:
+        if verbose>2: print('depth {} method instance {}'.format(depth,task1))
+        relevant = methods[task1[0]]
+        if task1[0][:len("produce_")] == "produce_":
+            relevant = reorder_methods(state, task1, tasks, plan, depth, calling_stack, relevant)
+        for method in relevant:
+            subtasks = _apply_method(method,state,task1,stats)
+            if verbose>2:
+                print('depth {} new tasks: {}'.format(depth,subtasks))
+            if subtasks != False:
+                yield (state,tasks.rest.push(subtasks),plan,depth+1,calling_stack.append(task1))
+                if stats is not None: stats.method_backtracks[method.__name__] += 1
+    if verbose>2: print('depth {} returns failure'.format(depth))
+
+############################################################
+# Looking for cheaper plans
+
+def branch_and_bound(state,tasks,cost,lower_bound=None,stop=None,verbose=0,trail=False,nogoods=None,stats=None):
+    """
+    Anytime search for the cheapest plan for tasks. Generator over
+    (plan, cost(plan)) pairs, each plan cheaper than the one before.
+    The depth-first search goes on after each plan, skipping every node for
+    which lower_bound(state,tasks,plan) is no less than the best cost so
+    far. lower_bound must never be more than the cost of the cheapest plan
+    through the node, or cheaper plans may be skipped. stop() is called at
+    every node; when it returns True the search ends. If the generator runs
+    out without stop() returning True, its last plan is the cheapest one.
+    nogoods must only be shared between searches with the same cost and
+    lower_bound.
+    """
+    best = None
+
+    def prune(state,tasks,plan):
+        return best is not None and lower_bound(state,tasks,plan) >= best
+
+    if trail:
+        state,trail = copy.deepcopy(state),[]
+    else:
+        trail = None
+    for plan in search(state,tasks,[],0,verbose,[],trail,nogoods,stats,prune if lower_bound else None,stop):
+        plan_cost = cost(plan)
+        if best is None or plan_cost < best:
+            best = plan_cost
+            if verbose>0: print('** branch_and_bound: plan of cost {} **'.format(plan_cost))
+            yield plan,plan_cost
+
+def best_plans(state,tasks,k,cost,max_plans=None,**options):
+    """
+    The k cheapest by cost(plan) of the first max_plans plans from
+    iter_plans (of all of them if max_plans is None), cheapest first.
+    options are passed on to iter_plans.
+    """
+    return heapq.nsmallest(k,itertools.islice(iter_plans(state,tasks,**options),max_plans),key=cost)
+
+############################################################
+# Replanning
+
+class Replanner(object):
+    """
+    Plans the same tasks again as the world changes, keeping as much of the
+    last plan as still works:
+
+        replanner = Replanner(tasks)
+        plan = replanner.plan(state)
+        ...                  # carry out n actions of plan; the world changes
+        plan = replanner.plan(state, executed=n)     # or tasks=new_tasks
+
+    Each plan is found with the tasks that are still open after each of its
+    actions, which is where its decomposition stands. The rest of the last
+    plan is run forward from the new state up to the first action that no
+    longer applies. Those actions are kept and only the tasks still open
+    after them are planned, so the search covers what the change broke
+    rather than the whole problem. If that search fails, the tasks open
+    before the first action left are planned again from the new state.
+    Kept actions that the change made unnecessary (say, after items were
+    gained) stay in the plan. Passing tasks (even the same ones) drops the
+    old plan and plans them from scratch. The search follows seek_plan's
+    order; verbose, trail and stats are used as in pyhop.
+    """
+    def __init__(self, tasks, verbose=0, trail=False, stats=None):
+        self.tasks = tasks
+        self.verbose = verbose
+        self.trail = trail
+        self.stats = stats
+        self.last_plan = None
+        # open_tasks[i] is the Agenda left after last_plan[i]
+        self.open_tasks = None
+
+    def plan(self, state, executed=0, tasks=None):
+        """
+        A plan for tasks (by default the last tasks) from state, or False.
+        executed is how many actions of the last plan have been carried out
+        to reach state.
+        """
+        if tasks is not None or not self.last_plan:
+            if tasks is not None:
+                self.tasks = tasks
+            return self._keep(*self._search(state, Agenda(self.tasks)))
+
+        todo = self.open_tasks[executed - 1] if executed else Agenda(self.tasks)
+        kept = 0
+        current = state
+        open_tasks = todo
+        for action in self.last_plan[executed:]:
+            newstate = operators[action[0]](copy.deepcopy(current),*action[1:])
+            if not newstate:
+                break
+            current = newstate
+            open_tasks = self.open_tasks[executed + kept]
+            kept += 1
+        rest, rest_open = self._search(current, open_tasks)
+        if rest is not False:
+            return self._keep(self.last_plan[executed:executed + kept] + rest,
+                              self.open_tasks[executed:executed + kept] + rest_open)
+        if kept:
+            return self._keep(*self._search(state, todo))
+        return self._keep(False, None)
+
+    def _keep(self, plan, open_tasks):
+        self.last_plan, self.open_tasks = plan, open_tasks
+        return plan
+
+    def _search(self, state, tasks):
+        """(plan, open tasks after each action) for the Agenda tasks, or (False, None)."""
+        if self.trail:
+            state,trail = copy.deepcopy(state),[]
+        else:
+            trail = None
+        stack = [iter([(state,tasks,Path(),0,CallingStack(),Path())])]
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+                if self.stats is not None: self.stats.backtracks += 1
+                continue
+            state,tasks,plan,depth,calling_stack,open_tasks = node
+            if not tasks:
+                return list(plan), list(open_tasks)
+            if self.stats is not None:
+                self.stats.nodes += 1
+                self.stats.expansions[tasks[0][0]] += 1
+            stack.append(_traced(expand(state,tasks,plan,depth,self.verbose,calling_stack,trail,self.stats), plan, open_tasks))
+        return False, None
+
+def _traced(children, plan, open_tasks):
+    """expand()'s children with open_tasks extended by the Agenda after each new action."""
+    for state,tasks,child_plan,depth,calling_stack in children:
+        if child_plan is not plan:
+            yield (state,tasks,child_plan,depth,calling_stack,open_tasks.append(tasks))
+        else:
+            yield (state,tasks,child_plan,depth,calling_stack,open_tasks)
@@ -0,0 +1,410 @@
+"""
+Plan crafting problems as a service, for callers such as a game loop that
+mustn't block on pyhop.
+
+The service declares one domain in a pool of worker processes and takes
+problems (dicts like those of batch.py) on a queue. The workers are
+spawned, so scripts that start a service need an if __name__ == '__main__'
+guard. Each worker plans one
+problem at a time with pyhop.search, whose stop hook ends the search
+cooperatively once the problem's deadline passes or its caller cancels it.
+A problem still queued at its deadline is answered without being planned.
+
+    service = PlanningService(data, workers=2)
+    async with service:
+        result = await service.plan({'goal': {'cart': 1}, 'time': 175}, timeout=0.5)
+        service.stats()
+
+Each result is a dict with the problem's 'name', a 'status' ('ok', 'no
+plan', 'timeout', 'cancelled', 'rejected' when the queue is full or
+'error', with the exception in 'error', for a malformed problem), the
+'plan' (False unless the status is 'ok'), its 'time_cost', the search
+'nodes', the 'runtime' spent planning and the 'latency' from the request to
+the result, in seconds. Cancelling the task that awaits plan() cancels the
+problem too. stats() reports the queue depth, the problems running, counts
+per status and percentiles of the latency of recent results.
+
+The service also listens on a Unix socket with serve_unix(path). The
+protocol is one JSON object per line each way: a problem, with an optional
+'id' and 'timeout', gets a result with the same 'id'; {'op': 'stats'} gets
+stats(), and {'op': 'cancel', 'id': ...} cancels a problem of the same
+connection. Results come back as they finish, not in request order, and a
+connection's problems are cancelled when it closes. Client is a stand-in
+for a game server:
+
+    python service.py crafting.json --socket /tmp/planner.sock
+    python service.py crafting.json --demo     # serve and run a Client on autoHTN.TEST_CASES
+"""
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import autoHTN
+import batch
+import pyhop
+
+ID = 'agent'
+
+def percentile(values, q):
+    """The q-th percentile (0 to 100) of the sorted list values, by nearest rank."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, -(-len(values) * q // 100) - 1))]
+
+class _Request(object):
+    def __init__(self, problem, deadline, future):
+        self.problem = problem
+        self.deadline = deadline    # time.monotonic() value, or None
+        self.future = future
+        self.start = time.monotonic()
+        self.slot = None            # the worker planning it, once it runs
+        self.cancelled = False
+
+class PlanningService(object):
+    """
+    Plans problems for data's domain in workers worker processes (one per
+    core by default). At most max_queue problems wait for a worker; more
+    are rejected. timeout is the default number of seconds a problem may
+    take, from its request to its result (None for no limit). The latency
+    percentiles cover the last window results. max_depth, bulk and
+    compiled declare the domain as in batch.declare_domain, and options
+    are passed on to pyhop.search (nogoods=pyhop.NogoodTable(), ...).
+    """
+    def __init__(self, data, workers=None, max_queue=1000, timeout=None, window=1000,
+                 ID=ID, max_depth=1000, bulk=False, compiled=False, **options):
+        self.data = data
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.ID = ID
+        self.declare = (max_depth, bulk, compiled)
+        self.options = options
+        self.latencies = collections.deque(maxlen=window)
+        self.counts = collections.Counter()
+        self.queued = 0
+        self.running = 0
+        self._queue = None
+        self._pool = None
+        self._tasks = []
+
+    async def start(self):
+        """Start the worker processes and wait for them to declare the domain."""
+        # The flags are shared with the workers: cancelled[slot] is 1 when
+        # the problem of worker slot should stop. The workers are spawned,
+        # not forked, so they don't hold on to the sockets of connections
+        context = multiprocessing.get_context('spawn')
+        self._cancelled = context.RawArray('b', self.workers)
+        self._pool = ProcessPoolExecutor(self.workers, mp_context=context, initializer=_init_worker,
+                                         initargs=(self.data, self._cancelled, self.ID) + self.declare)
+        # Each job that finds no idle worker starts one, so this waits for
+        # the workers to start and declare the domain
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self._pool, os.getpid) for _ in range(self.workers)])
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.ensure_future(self._work(slot)) for slot in range(self.workers)]
+
+    async def close(self):
+        """Cancel every problem, stop the workers and wait for the processes to exit."""
+        for task in self._tasks:
+            task.cancel()
+        for slot in range(self.workers):
+            self._cancelled[slot] = 1
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self._queue.empty():
+            request = self._queue.get_nowait()
+            if not request.future.done():
+                self.queued -= 1
+                self._finish(request, 'cancelled')
+        self._pool.shutdown(wait=True)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def plan(self, problem, timeout=None):
+        """
+        The result for problem, planned within timeout seconds (the
+        service's timeout by default).
+        """
+        request = self.submit(problem, timeout)
+        try:
+            return await asyncio.shield(request.future)
+        except asyncio.CancelledError:
+            self.cancel(request)
+            raise
+
+    def submit(self, problem, timeout=None):
+        """
+        Queue problem without waiting for it; the returned request's future
+        gets the result. Use cancel(request) to stop it.
+        """
+        loop = asyncio.get_running_loop()
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        request = _Request(problem, deadline, loop.create_future())
+        if self.queued >= self.max_queue:
+            self._finish(request, 'rejected')
+            return request
+        self.queued += 1
+        self._queue.put_nowait(request)
+        if deadline is not None:
+            # Answer it at its deadline if it's still waiting for a worker
+            loop.call_later(timeout, self._expire, request)
+        return request
+
+    def cancel(self, request):
+        """Stop request: drop it from the queue, or end its search at the next node."""
+        if request.future.done():
+            return
+        request.cancelled = True
+        if request.slot is not None:
+            self._cancelled[request.slot] = 1
+        else:
+            self.queued -= 1
+            self._finish(request, 'cancelled')
+
+    def _expire(self, request):
+        if request.slot is None and not request.future.done():
+            self.queued -= 1
+            self._finish(request, 'timeout')
+
+    async def _work(self, slot):
+        loop = asyncio.get_running_loop()
+        while True:
+            request = await self._queue.get()
+            if request.future.done():
+                continue
+            self.queued -= 1
+            if request.deadline is not None and time.monotonic() >= request.deadline:
+                self._finish(request, 'timeout')
+                continue
+            request.slot = slot
+            self._cancelled[slot] = 0
+            self.running += 1
+            try:
+                result = await loop.run_in_executor(
+                    self._pool, _plan, slot, request.problem, request.deadline, self.options)
+            except asyncio.CancelledError:
+                self._finish(request, 'cancelled')
+                raise
+            except Exception as e:
+                result = {'status': 'error', 'error': '{}: {}'.format(type(e).__name__, e)}
+            finally:
+                self.running -= 1
+                request.slot = None
+            status = result.pop('status')
+            if status == 'stopped':
+                status = 'cancelled' if request.cancelled else 'timeout'
+            self._finish(request, status, result)
+
+    def _finish(self, request, status, result=None):
+        if request.future.done():
+            return
+        result = dict(result or {}, status=status)
+        result.setdefault('name', request.problem.get('name'))
+        for field in ('plan', 'time_cost', 'nodes', 'runtime'):
+            result.setdefault(field, False if field == 'plan' else None)
+        result['latency'] = time.monotonic() - request.start
+        self.counts[status] += 1
+        if status != 'rejected':
+            self.latencies.append(result['latency'])
+        request.future.set_result(result)
+
+    def stats(self):
+        """Queue depth, problems running, results per status and latency percentiles in seconds."""
+        latencies = sorted(self.latencies)
+        return {
+            'queue_depth': self.queued,
+            'running': self.running,
+            'workers': self.workers,
+            'counts': dict(self.counts),
+            'latency': {'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+                        'p99': percentile(latencies, 99), 'max': latencies[-1] if latencies else None},
+        }
+
+    async def serve_unix(self, path):
+        """Start listening on the Unix socket path; returns the asyncio server."""
+        if os.path.exists(path):
+            os.unlink(path)
+        return await asyncio.start_unix_server(self._serve_connection, path)
+
+    async def _serve_connection(self, reader, writer):
+        requests = {}
+        replies = set()
+
+        async def reply(message_id, request):
+            result = await request.future
+            requests.pop(message_id, None)
+            write(dict(result, id=message_id))
+
+        def write(message):
+            writer.write(json.dumps(message).encode() + b'\n')
+
+        try:
+            async for line in reader:
+                try:
+                    message = json.loads(line)
+                except ValueError as e:
+                    write({'error': 'bad JSON: {}'.format(e)})
+                    continue
+                op = message.pop('op', 'plan')
+                message_id = message.pop('id', None)
+                if op == 'stats':
+                    write(dict(self.stats(), id=message_id))
+                elif op == 'cancel':
+                    if message_id in requests:
+                        self.cancel(requests[message_id])
+                elif op == 'plan':
+                    request = self.submit(message, message.pop('timeout', None))
+                    requests[message_id] = request
+                    task = asyncio.ensure_future(reply(message_id, request))
+                    replies.add(task)
+                    task.add_done_callback(replies.discard)
+                else:
+                    write({'id': message_id, 'error': 'unknown op {!r}'.format(op)})
+                await writer.drain()
+        finally:
+            for request in list(requests.values()):
+                self.cancel(request)
+            for task in list(replies):
+                task.cancel()
+            writer.close()
+
+# Set in each worker process by _init_worker
+_worker_data = None
+_worker_ID = ID
+_cancelled = None
+
+def _init_worker(data, cancelled, ID, max_depth, bulk, compiled):
+    global _worker_data, _worker_ID, _cancelled
+    _worker_data, _worker_ID, _cancelled = data, ID, cancelled
+    batch.declare_domain(data, ID, max_depth, bulk, compiled)
+
+def _plan(slot, problem, deadline, options):
+    problem_data = autoHTN.set_problem(_worker_data, problem.get('initial', {}), problem['goal'], problem['time'])
+    state = autoHTN.set_up_state(problem_data, _worker_ID)
+    goals = autoHTN.set_up_goals(problem_data, _worker_ID)
+    stats = pyhop.SearchStats()
+    if deadline is None:
+        stop = lambda: _cancelled[slot]
+    else:
+        stop = lambda: _cancelled[slot] or time.monotonic() > deadline
+
+    t0 = time.perf_counter()
+    plan = next(pyhop.search(state, goals, [], 0, stats=stats, stop=stop, **options), False)
+    runtime = time.perf_counter() - t0
+
+    if plan is not False:
+        status = 'ok'
+    elif stop():
+        status = 'stopped'
+    else:
+        status = 'no plan'
+    return {
+        'status': status,
+        'plan': plan,
+        'time_cost': autoHTN.plan_time(_worker_data, plan) if plan is not False else None,
+        'nodes': stats.nodes,
+        'runtime': runtime,
+    }
+
+class Client(object):
+    """A stand-in for a game server talking to serve_unix: connect, then await plan() and stats()."""
+    def __init__(self):
+        self._ids = itertools.count()
+        self._waiting = {}
+
+    async def connect(self, path):
+        self.reader, self.writer = await asyncio.open_unix_connection(path)
+        self._reader_task = asyncio.ensure_future(self._read())
+
+    async def close(self):
+        # The service closes the connection once it reads the end of ours,
+        # which ends _read
+        self.writer.write_eof()
+        await asyncio.gather(self._reader_task, return_exceptions=True)
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def _read(self):
+        async for line in self.reader:
+            message = json.loads(line)
+            future = self._waiting.pop(message.get('id'), None)
+            if future is not None and not future.done():
+                future.set_result(message)
+        for future in self._waiting.values():
+            future.cancel()
+
+    async def _send(self, message):
+        message_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[message_id] = future
+        self.writer.write(json.dumps(dict(message, id=message_id)).encode() + b'\n')
+        await self.writer.drain()
+        return message_id, future
+
+    async def plan(self, problem, timeout=None):
+        """The service's result for problem; cancelling this cancels it on the service."""
+        message = dict(problem)
+        if timeout is not None:
+            message['timeout'] = timeout
+        message_id, future = await self._send(message)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            self.writer.write(json.dumps({'op': 'cancel', 'id': message_id}).encode() + b'\n')
+            raise
+
+    async def stats(self):
+        message_id, future = await self._send({'op': 'stats'})
+        return await future
+
+async def _demo(data, path, workers, timeout):
+    async with PlanningService(data, workers, timeout=timeout) as service:
+        server = await service.serve_unix(path)
+        client = Client()
+        await client.connect(path)
+        results = await asyncio.gather(*[client.plan(case) for case in autoHTN.TEST_CASES])
+        for result in results:
+            print('{:<60} {:<9} {:>8.4f}s  {}'.format(
+                result['name'], result['status'], result['latency'],
+                '{} steps, time {}'.format(len(result['plan']), result['time_cost']) if result['plan'] else ''))
+        print(json.dumps(await client.stats(), indent=1))
+        await client.close()
+        server.close()
+        await server.wait_closed()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('domain', nargs='?', default='crafting.json')
+    parser.add_argument('--socket', default='/tmp/planner.sock')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--timeout', type=float, help='default seconds per problem')
+    parser.add_argument('--demo', action='store_true', help='plan the test cases with a stand-in client and exit')
+    args = parser.parse_args()
+
+    with open(args.domain) as f:
+        data = json.load(f)
+
+    if args.demo:
+        asyncio.run(_demo(data, args.socket, args.workers, args.timeout))
+    else:
+        async def main():
+            async with PlanningService(data, args.workers, timeout=args.timeout) as service:
+                server = await service.serve_unix(args.socket)
+                print('planning on', args.socket)
+                async with server:
+                    await server.serve_forever()
+        asyncio.run(main())
@@ -0,0 +1,214 @@
+"""
+Random crafting domains in the schema of crafting.json, for seeing how the
+planner scales with the size of the domain.
+
+    data = generate_domain(n_items=500, n_tools=40, tiers=4, fan_in=3,
+                           alternatives=2, depth=8, seed=0)
+
+The items are split into depth layers. Layer 0 items are gathered from
+nothing; an item in a higher layer is made from fan_in or fewer items of
+lower layers, at least one from the layer just below. Tools come in tiers:
+a tool of tier t is made from items and requires a tool of tier t - 1 (tier
+1 tools only need items). Every item has one recipe that requires no tool
+and up to alternatives - 1 faster ones that require a tool, like punching
+for wood versus using an axe, so every goal can be reached given enough
+Time. The Problem asks for a few items of the top layer, with twice the
+Time their tool-free recipes take.
+
+From the command line, python synthetic.py runs the scaling harness: for
+each size in --sizes it generates a domain and records how long it takes to
+load, to declare (operators, methods and heuristic) and to plan,
+along with the search nodes and the peak memory. --time-bound adds
+autoHTN's time bound to the checks.
+
+    python synthetic.py --sizes 50 200 1000 --out scaling.json
+    python synthetic.py --write big.json --sizes 2000
+"""
+
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+import autoHTN
+import pyhop
+
+ID = 'agent'
+
+def generate_domain(n_items=100, n_tools=10, tiers=3, fan_in=3, alternatives=2, depth=5, goals=2, seed=0):
+    """A random domain dict with n_items items, n_tools tools and a Problem."""
+    rng = random.Random(seed)
+    depth = max(1, min(depth, n_items))
+    tiers = max(1, min(tiers, n_tools)) if n_tools else 0
+
+    # item_<layer>_<n>, with every layer getting at least one item
+    layers = [[] for _ in range(depth)]
+    for i in range(n_items):
+        layer = i if i < depth else rng.randrange(depth)
+        layers[layer].append('item_{}_{}'.format(layer, len(layers[layer])))
+    tool_tiers = [[] for _ in range(tiers)]
+    for i in range(n_tools):
+        tier = i if i < tiers else rng.randrange(tiers)
+        tool_tiers[tier].append('tool_{}_{}'.format(tier + 1, len(tool_tiers[tier])))
+
+    recipes = {}
+
+    def inputs(layer):
+        # one input from the layer below, the rest from any lower layer
+        below = [item for lower in layers[:layer] for item in lower]
+        chosen = {rng.choice(layers[layer - 1])}
+        for _ in range(rng.randint(0, fan_in - 1)):
+            chosen.add(rng.choice(below))
+        return {item: rng.randint(1, 3) for item in sorted(chosen)}
+
+    for layer, items in enumerate(layers):
+        for item in items:
+            consumes = inputs(layer) if layer else {}
+            base_time = rng.randint(3, 8) if layer == 0 else rng.randint(1, 3)
+            produces = rng.randint(1, 2) if layer else 1
+            recipes['make {}'.format(item)] = _recipe({item: produces}, {}, consumes, base_time)
+            for n in range(alternatives - 1):
+                if not n_tools:
+                    break
+                tool = rng.choice(tool_tiers[rng.randrange(tiers)])
+                recipes['make {} with {}'.format(item, tool)] = _recipe(
+                    {item: produces}, {tool: 1}, consumes, max(1, base_time // 2))
+
+    for tier, tools in enumerate(tool_tiers):
+        for tool in tools:
+            layer = rng.randrange(1, depth) if depth > 1 else 0
+            consumes = inputs(layer) if layer else {rng.choice(layers[0]): rng.randint(1, 3)}
+            requires = {rng.choice(tool_tiers[tier - 1]): 1} if tier else {}
+            recipes['craft {}'.format(tool)] = _recipe({tool: 1}, requires, consumes, rng.randint(1, 3))
+
+    items = [item for layer in layers for item in layer]
+    tools = [tool for tier in tool_tiers for tool in tier]
+    data = {'Items': items, 'Tools': tools, 'Recipes': recipes}
+    goal = {item: rng.randint(1, 2) for item in rng.sample(layers[-1], min(goals, len(layers[-1])))}
+    data['Problem'] = {'Initial': {}, 'Goal': goal, 'Time': 2 * tool_free_time(data, goal)}
+    return data
+
+def _recipe(produces, requires, consumes, time_cost):
+    rule = {'Produces': produces}
+    if requires:
+        rule['Requires'] = requires
+    if consumes:
+        rule['Consumes'] = consumes
+    rule['Time'] = time_cost
+    return rule
+
+def tool_free_time(data, goal):
+    """Time to make goal from nothing with only the recipes that require no tool."""
+    recipes = {}
+    for rule in data['Recipes'].values():
+        if not rule.get('Requires'):
+            for product, amt in rule['Produces'].items():
+                recipes[product] = (rule, amt)
+    have = {}
+    total = 0
+
+    def make(item, num):
+        nonlocal total
+        while have.get(item, 0) < num:
+            rule, amt = recipes[item]
+            for needed, k in rule.get('Consumes', {}).items():
+                make(needed, k)
+                have[needed] -= k
+            total += rule['Time']
+            have[item] = have.get(item, 0) + amt
+
+    for item, num in goal.items():
+        make(item, num)
+    return total
+
+def declare(data, time_bound=False):
+    """Declare data's operators, methods and heuristic (and with time_bound, the time bound) in pyhop."""
+    # Operators and methods of earlier domains have other names, so only
+    # the checks need to go
+    pyhop.clear_checks()
+    autoHTN.declare_operators(data)
+    autoHTN.declare_methods(data)
+    autoHTN.add_heuristic(data, ID, max_depth=10**9)
+    if time_bound:
+        autoHTN.add_time_bound(data, ID)
+
+def plan(data, max_seconds, stats=None):
+    """The first plan for data's Problem, or False if there is none or max_seconds ran out."""
+    state = autoHTN.set_up_state(data, ID)
+    goals = autoHTN.set_up_goals(data, ID)
+    deadline = time.perf_counter() + max_seconds
+    return next(pyhop.search(state, goals, [], 0, stats=stats, stop=lambda: time.perf_counter() > deadline), False)
+
+def measure(data, max_seconds=60.0, memory=True, time_bound=False):
+    """
+    Load, declare and plan data's Problem; return the timings and counts.
+    With memory, declaring and planning are run again under tracemalloc
+    (which slows them down a lot) for the peak memory.
+    """
+    text = json.dumps(data)
+    t0 = time.perf_counter()
+    data = json.loads(text)
+    t1 = time.perf_counter()
+    declare(data, time_bound)
+    t2 = time.perf_counter()
+    stats = pyhop.SearchStats()
+    found = plan(data, max_seconds, stats)
+    t3 = time.perf_counter()
+
+    peak_memory = None
+    if memory:
+        tracemalloc.start()
+        declare(data, time_bound)
+        plan(data, max_seconds)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'items': len(data['Items']),
+        'tools': len(data['Tools']),
+        'recipes': len(data['Recipes']),
+        'load_time': t1 - t0,
+        'declare_time': t2 - t1,
+        'plan_time': t3 - t2,
+        'timed_out': found is False and t3 - t2 > max_seconds,
+        'nodes': stats.nodes,
+        'backtracks': stats.backtracks,
+        'plan_length': len(found) if found is not False else None,
+        'peak_memory': peak_memory,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[25, 50, 100, 200, 400, 800])
+    parser.add_argument('--tools', type=float, default=0.1, help='tools per item')
+    parser.add_argument('--tiers', type=int, default=3)
+    parser.add_argument('--fan-in', type=int, default=3)
+    parser.add_argument('--alternatives', type=int, default=2)
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-seconds', type=float, default=60.0, help='search time limit per size')
+    parser.add_argument('--no-memory', action='store_true', help="don't measure peak memory")
+    parser.add_argument('--time-bound', action='store_true', help="add autoHTN's time bound to the checks")
+    parser.add_argument('--write', help='write the domain of the last size to this JSON file')
+    parser.add_argument('--out', help='write the measurements to this JSON file')
+    args = parser.parse_args()
+
+    runs = []
+    for size in args.sizes:
+        data = generate_domain(size, max(1, int(size * args.tools)), args.tiers, args.fan_in,
+                               args.alternatives, args.depth, seed=args.seed)
+        m = measure(data, args.max_seconds, not args.no_memory, args.time_bound)
+        runs.append(m)
+        print('{:>6} items {:>5} tools {:>6} recipes  load {:.4f}s  declare {:.4f}s  plan {:.4f}s{}  '
+              '{:>8} nodes  plan {}  {:>10} bytes'.format(
+                  m['items'], m['tools'], m['recipes'], m['load_time'], m['declare_time'], m['plan_time'],
+                  ' (timed out)' if m['timed_out'] else '', m['nodes'], m['plan_length'],
+                  '-' if m['peak_memory'] is None else m['peak_memory']))
+
+    if args.write:
+        with open(args.write, 'w') as f:
+            json.dump(data, f, indent=1)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(runs, f, indent=1)
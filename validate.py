@@ -0,0 +1,218 @@
+"""
+Check crafting plans against a domain without running the planner.
+
+Every recipe is compiled once into the slots and amounts it needs,
+consumes and produces, in the layout of autoHTN.make_index. A plan is
+then replayed on a list of counts, one action at a time, and the report
+says whether it holds up:
+
+    validator = PlanValidator(data)
+    report = validator.validate(plan, initial={'plank': 1}, goal={'cart': 1}, max_time=175)
+    reports = validator.validate_batch(cases)
+
+Each report is a dict with
+- valid      True if every action could run and the goal (if any) holds
+- step       index of the first action that couldn't run, len(plan) if
+             only the goal failed, None if the plan is valid
+- reason     why that step failed, None if the plan is valid
+- inventory  {item or tool: count} after the last action that ran
+- time_used  Time spent by the actions that ran
+
+Plans may contain bulk actions ('op_...', ID, k), which run the recipe k
+times. From the command line, python validate.py cases.json checks a JSON
+list of {'plan', 'initial', 'goal', 'time'} cases.
+"""
+
+import json
+import sys
+
+import autoHTN
+
+ID = 'agent'
+
+class PlanValidator(object):
+    """Replays plans for one domain. initial, goal and max_time default to data['Problem']."""
+    def __init__(self, data, ID=ID):
+        self.data = data
+        self.ID = ID
+        self.index = autoHTN.make_index(data)
+        self.names = sorted(self.index, key=self.index.get)
+        # 'op_<recipe>' -> (Time, [(slot, amount)] for Requires, Consumes, Produces)
+        self.actions = {}
+        for recipe_name, rule in data['Recipes'].items():
+            self.actions['op_' + recipe_name.replace(' ', '_')] = (
+                rule.get('Time', 0),
+                [(self.index[item], amt) for item, amt in rule.get('Requires', {}).items()],
+                [(self.index[item], amt) for item, amt in rule.get('Consumes', {}).items()],
+                [(self.index[item], amt) for item, amt in rule.get('Produces', {}).items()])
+
+    def start_row(self, initial=None, max_time=None):
+        """The counts, in slot order, before the first action."""
+        problem = self.data.get('Problem', {})
+        if initial is None:
+            initial = problem.get('Initial', {})
+        if max_time is None:
+            max_time = problem.get('Time', 0)
+        row = [0] * len(self.index)
+        row[self.index['time']] = max_time
+        for item, num in initial.items():
+            row[self.index[item]] = num
+        return row
+
+    def validate(self, plan, initial=None, goal=None, max_time=None):
+        """The report for plan from initial, with goal checked after the last action."""
+        if goal is None:
+            goal = self.data.get('Problem', {}).get('Goal')
+        return self._replay(plan, self.start_row(initial, max_time), goal)
+
+    def validate_batch(self, cases):
+        """
+        Reports for a list of cases, dicts with a 'plan' and optionally
+        'initial', 'goal' and 'time'. Identical cases are replayed once and
+        share their report. From its second case on, a plan is checked
+        against each start row with its profile instead of being replayed;
+        failing cases are still replayed for their step and reason.
+        """
+        problem = self.data.get('Problem', {})
+        reports = []
+        seen = {}
+        profiles = {}
+        replayed = set()
+        t_slot = self.index['time']
+        for case in cases:
+            plan = case['plan']
+            goal = case.get('goal', problem.get('Goal'))
+            row = self.start_row(case.get('initial'), case.get('time'))
+            plan_key = tuple(map(tuple, plan)) if plan is not False else False
+            key = (plan_key, tuple(row), tuple(sorted(goal.items())) if goal else None)
+            if key not in seen:
+                profile = profiles.get(plan_key, False)
+                if profile is False:
+                    # Profiling costs more than a replay, so only repeated plans get one
+                    if plan_key in replayed:
+                        profile = profiles[plan_key] = self._profile(plan)
+                    else:
+                        replayed.add(plan_key)
+                        profile = None
+                if profile is not None and all(row[slot] >= least for slot, least in profile[0]):
+                    start_time = row[t_slot]
+                    for slot, change in profile[1]:
+                        row[slot] += change
+                    seen[key] = self._report(row, start_time, None, None, goal, len(plan))
+                else:
+                    seen[key] = self._replay(plan, row, goal)
+            reports.append(seen[key])
+        return reports
+
+    def _profile(self, plan):
+        """
+        ([(slot, least count at the start)], [(slot, net change)]) for plan,
+        or None if it fails whatever the start row is. plan runs from a row
+        exactly when every slot starts with at least its least count.
+        """
+        if plan is False:
+            return None
+        t_slot = self.index['time']
+        actions = self.actions
+        least = {}
+        change = {}
+        for action in plan:
+            effects = actions.get(action[0])
+            if effects is None or action[1] != self.ID:
+                return None
+            k = action[2] if len(action) > 2 else 1
+            if k < 1:
+                return None
+            t_c, req_slots, cons_slots, prod_slots = effects
+            needs = [(t_slot, t_c * k)] + req_slots + [(slot, amt * k) for slot, amt in cons_slots]
+            for slot, amt in needs:
+                amt -= change.get(slot, 0)
+                if slot not in least or amt > least[slot]:
+                    least[slot] = amt
+            change[t_slot] = change.get(t_slot, 0) - t_c * k
+            for slot, amt in cons_slots:
+                change[slot] = change.get(slot, 0) - amt * k
+            for slot, amt in prod_slots:
+                change[slot] = change.get(slot, 0) + amt * k
+        return list(least.items()), list(change.items())
+
+    def _replay(self, plan, row, goal):
+        t_slot = self.index['time']
+        start_time = row[t_slot]
+        step, reason = None, None
+        if plan is False:
+            step, reason = 0, 'no plan'
+            plan = []
+
+        actions = self.actions
+        for i, action in enumerate(plan):
+            effects = actions.get(action[0])
+            if effects is None:
+                step, reason = i, 'unknown action {}'.format(action[0])
+                break
+            if action[1] != self.ID:
+                step, reason = i, 'action for agent {!r}, not {!r}'.format(action[1], self.ID)
+                break
+            k = action[2] if len(action) > 2 else 1
+            if k < 1:
+                step, reason = i, 'repeat count {} is less than 1'.format(k)
+                break
+            t_c, req_slots, cons_slots, prod_slots = effects
+            if row[t_slot] < t_c * k:
+                step, reason = i, 'needs {} time, {} left'.format(t_c * k, row[t_slot])
+                break
+            for slot, amt in req_slots:
+                if row[slot] < amt:
+                    step, reason = i, 'requires {} {}, has {}'.format(amt, self.names[slot], row[slot])
+                    break
+            else:
+                for slot, amt in cons_slots:
+                    if row[slot] < amt * k:
+                        step, reason = i, 'consumes {} {}, has {}'.format(amt * k, self.names[slot], row[slot])
+                        break
+            if reason is not None:
+                break
+            row[t_slot] -= t_c * k
+            for slot, amt in cons_slots:
+                row[slot] -= amt * k
+            for slot, amt in prod_slots:
+                row[slot] += amt * k
+
+        return self._report(row, start_time, step, reason, goal, len(plan))
+
+    def _report(self, row, start_time, step, reason, goal, steps):
+        t_slot = self.index['time']
+        if reason is None and goal:
+            for item, num in goal.items():
+                if row[self.index[item]] < num:
+                    step, reason = steps, 'goal needs {} {}, has {}'.format(num, item, row[self.index[item]])
+                    break
+
+        return {
+            'valid': reason is None,
+            'step': step,
+            'reason': reason,
+            'inventory': {name: row[slot] for slot, name in enumerate(self.names) if slot != t_slot},
+            'time_used': start_time - row[t_slot],
+        }
+
+if __name__ == '__main__':
+    import time
+
+    if len(sys.argv) < 2:
+        sys.exit('usage: python validate.py cases.json [crafting.json]')
+    with open(sys.argv[1]) as f:
+        cases = json.load(f)
+    rules_filename = sys.argv[2] if len(sys.argv) > 2 else 'crafting.json'
+    with open(rules_filename) as f:
+        data = json.load(f)
+
+    validator = PlanValidator(data)
+    t0 = time.perf_counter()
+    reports = validator.validate_batch(cases)
+    t1 = time.perf_counter()
+    for i, report in enumerate(reports):
+        if not report['valid']:
+            print('case {}: step {}: {}'.format(cases[i].get('name', i), report['step'], report['reason']))
+    print('{} of {} plans valid, checked in {:.4f} seconds'.format(
+        sum(report['valid'] for report in reports), len(reports), t1 - t0))